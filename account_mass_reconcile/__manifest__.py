@@ -4,7 +4,7 @@
 
 {
     "name": "Account Mass Reconcile",
-    "version": "12.0.1.0.0",
+    "version": "12.0.1.1.0",
     "depends": [
         "account",
     ],
@@ -16,6 +16,7 @@
         "security/ir.model.access.csv",
         "views/mass_reconcile.xml",
         "views/mass_reconcile_history_view.xml",
+        "views/mass_reconcile_simulation_view.xml",
         "views/res_config_view.xml",
     ],
     'license': 'AGPL-3',
@@ -0,0 +1,25 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+
+def migrate(cr, version):
+    if not version:
+        return
+    # the reconciled items of the history were computed, store them
+    cr.execute(
+        "INSERT INTO account_move_line_history_rel "
+        "(mass_reconcile_history_id, account_move_line_id) "
+        "SELECT DISTINCT rel.mass_reconcile_history_id, line.id "
+        "FROM account_full_reconcile_history_rel rel "
+        "JOIN account_move_line line "
+        "ON line.full_reconcile_id = rel.account_full_reconcile_id"
+    )
+    cr.execute(
+        "UPDATE mass_reconcile_history history "
+        "SET reconcile_count = ("
+        "    SELECT count(*) FROM account_full_reconcile_history_rel rel "
+        "    WHERE rel.mass_reconcile_history_id = history.id), "
+        "reconcile_line_count = ("
+        "    SELECT count(*) FROM account_move_line_history_rel rel "
+        "    WHERE rel.mass_reconcile_history_id = history.id)"
+    )
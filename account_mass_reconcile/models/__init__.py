@@ -3,5 +3,8 @@ from . import base_reconciliation
 from . import base_advanced_reconciliation
 from . import simple_reconciliation
 from . import advanced_reconciliation
+from . import subset_reconciliation
 from . import mass_reconcile_history
+from . import mass_reconcile_simulation
 from . import res_config
+from . import account_move_line
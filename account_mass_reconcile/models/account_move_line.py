@@ -0,0 +1,20 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+from odoo.tools.sql import index_exists
+
+
+class AccountMoveLine(models.Model):
+    _inherit = 'account.move.line'
+
+    @api.model_cr
+    def init(self):
+        # used by the incremental runs to find the unreconciled lines
+        # changed since the last run
+        index_name = 'account_move_line_mass_reconcile_write_date_index'
+        if not index_exists(self._cr, index_name):
+            self._cr.execute(
+                "CREATE INDEX %s ON account_move_line "
+                "(account_id, write_date) WHERE NOT reconciled" % index_name
+            )
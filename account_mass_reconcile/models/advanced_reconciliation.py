@@ -10,6 +10,13 @@ class MassReconcileAdvancedRef(models.TransientModel):
     _name = 'mass.reconcile.advanced.ref'
     _inherit = 'mass.reconcile.advanced'
 
+    # the lines without partner are skipped and the partner
+    # is a matcher
+    _shard_by_partner = True
+
+    def _incremental_key_field(self):
+        return 'partner_id'
+
     @staticmethod
     def _skip_line(move_line):
         """
@@ -58,7 +65,7 @@ class MassReconcileAdvancedRef(models.TransientModel):
             A matching key can have multiples values.
         """
         return (('partner_id', move_line['partner_id']),
-                ('ref', move_line['ref'].lower().strip()))
+                ('ref', move_line['ref']))
 
     @staticmethod
     def _opposite_matchers(move_line):
@@ -67,8 +74,8 @@ class MassReconcileAdvancedRef(models.TransientModel):
         so the line is matched
 
         Must be inherited to implement the matchers for one method
-        It can be inherited to apply some formatting of fields
-        (strip(), lower() and so on)
+        The values are formatted (strip(), lower() and so on) by
+        `_normalize_matcher_value()`
 
         This method is the counterpart of the `_matchers()` method.
 
@@ -100,5 +107,10 @@ class MassReconcileAdvancedRef(models.TransientModel):
         :yield: matchers as tuple ('matcher key', value(s))
         """
         yield ('partner_id', move_line['partner_id'])
-        yield ('ref', ((move_line['ref'] or '').lower().strip(),
-                       move_line['name'].lower().strip()))
+        yield ('ref', (move_line['ref'], move_line['name']))
+
+    @staticmethod
+    def _normalize_matcher_value(key, value):
+        if key == 'ref':
+            return (value or '').lower().strip()
+        return value
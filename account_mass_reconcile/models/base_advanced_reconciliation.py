@@ -11,31 +11,110 @@ from odoo.tools.translate import _
 _logger = logging.getLogger(__name__)
 
 
+class ReconcileGroups(object):
+    """ Disjoint-set (union-find) of move line ids
+
+    Lines matched together are merged in the same group, transitively:
+    when a line is matched with lines of two different groups, both
+    groups are merged.
+    """
+
+    def __init__(self):
+        self._parent = {}
+        self._size = {}
+        # ids in order of insertion, used to return the groups
+        # in a stable order
+        self._ids = []
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, line_id):
+        return line_id in self._parent
+
+    def _add(self, line_id):
+        if line_id not in self._parent:
+            self._parent[line_id] = line_id
+            self._size[line_id] = 1
+            self._ids.append(line_id)
+
+    def find(self, line_id):
+        """ Return the id representing the group of a line """
+        parent = self._parent
+        while parent[line_id] != line_id:
+            # path halving
+            parent[line_id] = parent[parent[line_id]]
+            line_id = parent[line_id]
+        return line_id
+
+    def union(self, line_ids):
+        """ Merge the given lines and their groups in one group """
+        root = None
+        for line_id in line_ids:
+            self._add(line_id)
+            other = self.find(line_id)
+            if root is None:
+                root = other
+                continue
+            if other == root:
+                continue
+            if self._size[root] < self._size[other]:
+                root, other = other, root
+            self._parent[other] = root
+            self._size[root] += self._size[other]
+
+    def groups(self):
+        """ Return the groups as a list of sets of ids, ordered by the
+        first id added in each group
+        """
+        groups = {}
+        result = []
+        for line_id in self._ids:
+            root = self.find(line_id)
+            if root not in groups:
+                groups[root] = set()
+                result.append(groups[root])
+            groups[root].add(line_id)
+        return result
+
+
 class MassReconcileAdvanced(models.AbstractModel):
     _name = 'mass.reconcile.advanced'
     _inherit = 'mass.reconcile.base'
 
     def _query_debit(self):
         """Select all move (debit>0) as candidate. """
+        snapshot = self._get_snapshot()
+        if snapshot is not None:
+            lines = [l for l in snapshot.lines if l['debit'] > 0]
+            self._get_stats().lines_fetched += len(lines)
+            return lines
         select = self._select_query()
         sql_from = self._from_query()
         where, params = self._where_query()
         where += " AND account_move_line.debit > 0 "
         where2, params2 = self._get_filter()
         query = ' '.join((select, sql_from, where, where2))
-        self.env.cr.execute(query, params + params2)
-        return self.env.cr.dictfetchall()
+        return self._fetch_lines(query, params + params2)
 
     def _query_credit(self):
         """Select all move (credit>0) as candidate. """
+        snapshot = self._get_snapshot()
+        if snapshot is not None:
+            lines = [l for l in snapshot.lines if l['credit'] > 0 and
+                     l['id'] >= self.resume_from_id]
+            self._get_stats().lines_fetched += len(lines)
+            return lines
         select = self._select_query()
         sql_from = self._from_query()
         where, params = self._where_query()
         where += " AND account_move_line.credit > 0 "
+        if self.resume_from_id:
+            where += " AND account_move_line.id >= %s "
+            params = params + [self.resume_from_id]
         where2, params2 = self._get_filter()
         query = ' '.join((select, sql_from, where, where2))
-        self.env.cr.execute(query, params + params2)
-        return self.env.cr.dictfetchall()
+        return self._fetch_lines(query, params + params2)
 
     @staticmethod
     def _matchers(move_line):
@@ -84,8 +163,8 @@ class MassReconcileAdvanced(models.AbstractModel):
         so the line is matched
 
         Must be inherited to implement the matchers for one method
-        It can be inherited to apply some formatting of fields
-        (strip(), lower() and so on)
+        The values are formatted (strip(), lower() and so on) by
+        `_normalize_matcher_value()`
 
         This method is the counterpart of the `_matchers()` method.
 
@@ -118,6 +197,35 @@ class MassReconcileAdvanced(models.AbstractModel):
         """
         raise NotImplementedError
 
+    @staticmethod
+    def _normalize_matcher_value(key, value):
+        """ Format a value of the matcher ``key`` before it is compared
+        (strip(), lower() and so on)
+
+        The values returned by `_matchers()` and `_opposite_matchers()`
+        are normalized once per line, when the lines are loaded, instead
+        of at every comparison. Can be inherited to declare the
+        normalization of a method.
+        """
+        return value
+
+    def _prepare_matchers(self, matchers):
+        """ Normalize the values of matchers
+
+        :param matchers: matchers as returned by `_matchers()` or
+                         `_opposite_matchers()`
+        :return: tuple of tuples (key, tuple of normalized values)
+        """
+        normalize = self._normalize_matcher_value
+        prepared = []
+        for key, values in matchers:
+            if not isinstance(values, (list, tuple)):
+                values = values,
+            prepared.append(
+                (key, tuple(normalize(key, value) for value in values))
+            )
+        return tuple(prepared)
+
     @staticmethod
     def _compare_values(key, value, opposite_value):
         """Can be inherited to modify the equality condition
@@ -163,46 +271,169 @@ class MassReconcileAdvanced(models.AbstractModel):
         return MassReconcileAdvanced._compare_matcher_values(mkey, mvalue,
                                                              omvalue)
 
+    def _is_indexable_matcher(self, key):
+        """ Return True when the values of the matcher ``key`` can be
+        looked up in a hash index, which is the case when they are
+        compared for equality.
+
+        By default, a matcher is indexable as long as none of the
+        comparison methods is overridden. A method which only changes
+        the comparison of some keys (using a like operator on 'ref' as
+        instance) can inherit this method to keep the other keys indexed.
+        """
+        return not any(
+            self._is_overridden(name)
+            for name in ('_compare_opposite', '_compare_prepared',
+                         '_compare_matchers', '_compare_matcher_values',
+                         '_compare_values')
+        )
+
+    def _is_overridden(self, name):
+        method = getattr(type(self), name)
+        base_method = getattr(MassReconcileAdvanced, name)
+        return (getattr(method, '__func__', method) is not
+                getattr(base_method, '__func__', base_method))
+
+    def _build_opposite_index(self, opposite_move_lines,
+                              opposite_matchers=None):
+        """ Index the opposite move lines on the values of their
+        indexable matchers
+
+        The index of a key stops at the first matcher which is not
+        indexable. Empty values are not indexed as they never match.
+
+        :param list opposite_move_lines: list of dict of move lines values
+        :param list opposite_matchers: prepared `_opposite_matchers` of the
+          lines, in the same order, computed when not given
+        :return: dict {matcher key: {value: set of positions of the lines
+          in opposite_move_lines}}
+        """
+        if opposite_matchers is None:
+            opposite_matchers = self._prepare_opposite_matchers(
+                opposite_move_lines
+            )
+        index = {}
+        indexable = {}
+        for position, line_matchers in enumerate(opposite_matchers):
+            for key, values in line_matchers:
+                if key not in indexable:
+                    indexable[key] = self._is_indexable_matcher(key)
+                if not indexable[key]:
+                    break
+                key_index = index.setdefault(key, {})
+                for value in values:
+                    if value:
+                        key_index.setdefault(value, set()).add(position)
+        return index
+
+    def _prepare_opposite_matchers(self, opposite_move_lines):
+        """ Evaluate and normalize the `_opposite_matchers` of lines
+
+        The result is kept next to the lines rather than in their dict,
+        as the lines can be shared with methods normalizing differently.
+
+        :return: list of prepared matchers, in the order of the lines
+        """
+        return [self._prepare_matchers(self._opposite_matchers(line))
+                for line in opposite_move_lines]
+
     def _compare_opposite(self, move_line, opposite_move_line, matchers):
         """ Iterate over the matchers of the move lines vs opposite move lines
         and if they all match, return True.
 
         If all the matchers match for a move line and an opposite move line,
         they are candidate for a reconciliation.
-        """
-        opp_matchers = self._opposite_matchers(opposite_move_line)
-        for matcher in matchers:
-            try:
-                opp_matcher = next(opp_matchers)
-            except StopIteration:
-                # if you fall here, you probably missed to put a `yield`
-                # in `_opposite_matchers()`
-                raise ValueError("Missing _opposite_matcher: %s" % matcher[0])
 
+        :param matchers: matchers of the move line, prepared by
+                         `_prepare_matchers()`
+        """
+        return self._compare_prepared(
+            matchers,
+            self._prepare_matchers(self._opposite_matchers(opposite_move_line))
+        )
+
+    def _compare_prepared(self, matchers, opposite_matchers):
+        """ Compare the prepared matchers of a move line with the prepared
+        matchers of an opposite move line
+        """
+        if len(opposite_matchers) < len(matchers):
+            # if you fall here, you probably missed to put a `yield`
+            # in `_opposite_matchers()`
+            raise ValueError("Missing _opposite_matcher: %s" %
+                             matchers[len(opposite_matchers)][0])
+        for matcher, opp_matcher in zip(matchers, opposite_matchers):
             if not self._compare_matchers(matcher, opp_matcher):
                 # if any of the matcher fails, the opposite line
                 # is not a valid counterpart
-                # directly returns so the next yield of _opposite_matchers
-                # are not evaluated
                 return False
-
         return True
 
-    def _search_opposites(self, move_line, opposite_move_lines):
+    def _search_opposites(self, move_line, opposite_move_lines, index=None,
+                          opposite_matchers=None):
         """Search the opposite move lines for a move line
 
+        When an index built by `_build_opposite_index` is given, only the
+        opposite lines found in the index for every indexed matcher are
+        compared with the move line.
+
         :param dict move_line: the move line for which we search opposites
         :param list opposite_move_lines: list of dict of move lines values,
           the move lines we want to search for
+        :param dict index: optional index of the opposite move lines
+        :param list opposite_matchers: optional prepared matchers of the
+          opposite move lines, see `_prepare_opposite_matchers`
         :return: list of matching lines
         """
-        matchers = self._matchers(move_line)
-        return [op for op in opposite_move_lines if
-                self._compare_opposite(move_line, op, matchers)]
+        matchers = self._prepare_matchers(self._matchers(move_line))
+        positions = range(len(opposite_move_lines))
+        if index is not None:
+            found = self._probe_opposite_index(matchers, index)
+            if found is not None:
+                positions = sorted(found)
+        self._get_stats().comparisons += len(positions)
+        if (opposite_matchers is None or
+                self._is_overridden('_compare_opposite')):
+            return [opposite_move_lines[position] for position in positions
+                    if self._compare_opposite(move_line,
+                                              opposite_move_lines[position],
+                                              matchers)]
+        return [opposite_move_lines[position] for position in positions
+                if self._compare_prepared(matchers,
+                                          opposite_matchers[position])]
+
+    @staticmethod
+    def _probe_opposite_index(matchers, index):
+        """ Return the positions of the opposite lines which match all the
+        indexed prepared matchers, or None when no matcher is indexed
+        """
+        candidate_sets = []
+        for key, values in matchers:
+            key_index = index.get(key)
+            if key_index is None:
+                continue
+            sets = [key_index[value] for value in values
+                    if value and value in key_index]
+            if not sets:
+                return set()
+            if len(sets) == 1:
+                candidate_sets.append(sets[0])
+            else:
+                candidate_sets.append(set().union(*sets))
+        if not candidate_sets:
+            return None
+        # intersect starting with the most selective matcher
+        candidate_sets.sort(key=len)
+        positions = candidate_sets[0]
+        for other_positions in candidate_sets[1:]:
+            positions = positions & other_positions
+            if not positions:
+                break
+        return positions
 
     def _action_rec(self):
-        credit_lines = self._query_credit()
+        # the debit lines are indexed before the credit lines are read
         debit_lines = self._query_debit()
+        credit_lines = self._query_credit()
         result = self._rec_auto_lines_advanced(credit_lines, debit_lines)
         return result
 
@@ -216,56 +447,97 @@ class MassReconcileAdvanced(models.AbstractModel):
 
     @api.multi
     def _rec_auto_lines_advanced(self, credit_lines, debit_lines):
-        """ Advanced reconciliation main loop """
+        """ Advanced reconciliation main loop
+
+        :param credit_lines: iterable of dict of credit move lines, it is
+                             consumed once, so it can be a stream
+        :param debit_lines: iterable of dict of debit move lines
+        """
         reconciled_ids = []
+        stats = self._get_stats()
         for rec in self:
-            reconcile_groups = []
+            groups = ReconcileGroups()
             ctx = self.env.context.copy()
-            ctx['commit_every'] = (
-                rec.account_id.company_id.reconciliation_commit_every
-            )
-            _logger.info("%d credit lines to reconcile", len(credit_lines))
-            for idx, credit_line in enumerate(credit_lines, start=1):
-                if idx % 50 == 0:
-                    _logger.info("... %d/%d credit lines inspected ...", idx,
-                                 len(credit_lines))
-                if self._skip_line(credit_line):
-                    continue
-                opposite_lines = self._search_opposites(credit_line,
-                                                        debit_lines)
-                if not opposite_lines:
-                    continue
-                opposite_ids = [l['id'] for l in opposite_lines]
-                line_ids = opposite_ids + [credit_line['id']]
-                for group in reconcile_groups:
-                    if any([lid in group for lid in opposite_ids]):
-                        _logger.debug("New lines %s matched with an existing "
-                                      "group %s", line_ids, group)
-                        group.update(line_ids)
-                        break
-                else:
-                    _logger.debug("New group of lines matched %s", line_ids)
-                    reconcile_groups.append(set(line_ids))
-            lines_by_id = dict([(l['id'], l)
-                                for l in credit_lines + debit_lines])
+            ctx['commit_every'] = rec._get_commit_every()
+            # matched credit lines and last inspected credit line, used
+            # to resume the run
+            credit_ids = set()
+            last_credit_id = 0
+            with stats.timer('matching_time'):
+                debit_lines = list(debit_lines)
+                # the matchers of the debit lines are normalized once
+                debit_matchers = self._prepare_opposite_matchers(
+                    debit_lines
+                )
+                debit_index = self._build_opposite_index(
+                    debit_lines, opposite_matchers=debit_matchers
+                )
+                lines_by_id = dict([(l['id'], l) for l in debit_lines])
+                _logger.info("%d debit lines indexed", len(debit_lines))
+                idx = 0
+                for idx, credit_line in enumerate(credit_lines, start=1):
+                    if idx % 50 == 0:
+                        _logger.info("... %d credit lines inspected ...",
+                                     idx)
+                    last_credit_id = max(last_credit_id, credit_line['id'])
+                    if self._skip_line(credit_line):
+                        continue
+                    opposite_lines = self._search_opposites(
+                        credit_line, debit_lines, index=debit_index,
+                        opposite_matchers=debit_matchers)
+                    if not opposite_lines:
+                        continue
+                    # only the matched credit lines are kept in memory
+                    lines_by_id[credit_line['id']] = credit_line
+                    credit_ids.add(credit_line['id'])
+                    line_ids = [credit_line['id']]
+                    line_ids += [l['id'] for l in opposite_lines]
+                    _logger.debug("New lines matched %s", line_ids)
+                    groups.union(line_ids)
+                _logger.info("%d credit lines inspected", idx)
+                reconcile_groups = groups.groups()
+            stats.groups += len(reconcile_groups)
             _logger.info("Found %d groups to reconcile",
                          len(reconcile_groups))
-            for group_count, reconcile_group_ids \
-                    in enumerate(reconcile_groups, start=1):
-                _logger.debug("Reconciling group %d/%d with ids %s",
-                              group_count, len(reconcile_groups),
-                              reconcile_group_ids)
-                group_lines = [lines_by_id[lid]
-                               for lid in reconcile_group_ids]
-                reconciled, full = self._reconcile_lines(group_lines,
-                                                         allow_partial=True)
-                if reconciled and full:
-                    reconciled_ids += reconcile_group_ids
+            # a run interrupted after a batch is resumed from the first
+            # credit line of the following groups: the previous credit
+            # lines are reconciled or did not match
+            resume_ids = [last_credit_id + 1]
+            for reconcile_group_ids in reversed(reconcile_groups):
+                resume_ids.append(min(
+                    [resume_ids[-1]] +
+                    [lid for lid in reconcile_group_ids if lid in credit_ids]
+                ))
+            resume_ids.reverse()
+            # the groups are reconciled by batches, committed when
+            # commit_every is set
+            batch_size = ctx['commit_every'] or len(reconcile_groups)
+            for start in range(0, len(reconcile_groups), batch_size):
+                batch = reconcile_groups[start:start + batch_size]
+                _logger.debug("Reconciling groups %d to %d of %d",
+                              start + 1, start + len(batch),
+                              len(reconcile_groups))
+                results = self._reconcile_groups(
+                    [[lines_by_id[lid] for lid in reconcile_group_ids]
+                     for reconcile_group_ids in batch],
+                    allow_partial=True
+                )
+                batch_ids = []
+                for reconcile_group_ids, (reconciled, full) in zip(batch,
+                                                                   results):
+                    if reconciled and full:
+                        batch_ids += reconcile_group_ids
+                reconciled_ids += batch_ids
 
                 if (ctx['commit_every'] and
-                        group_count % ctx['commit_every'] == 0):
+                        len(batch) == ctx['commit_every']):
+                    self._checkpoint(
+                        batch_ids,
+                        resume_from_id=resume_ids[start + len(batch)]
+                    )
                     self.env.cr.commit()
+                    stats.commits += 1
                     _logger.info("Commit the reconciliations after %d groups",
-                                 group_count)
+                                 start + len(batch))
             _logger.info("Reconciliation is over")
         return reconciled_ids
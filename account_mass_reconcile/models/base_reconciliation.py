@@ -2,18 +2,213 @@
 # Copyright 2010 Sébastien Beau
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+from collections.abc import Mapping
+from contextlib import contextmanager
 from functools import reduce
 from operator import itemgetter
+from uuid import uuid4
+import time
 
 from odoo import _, api, fields, models
 from odoo.tools.safe_eval import safe_eval
 
+from .candidate_columns import CandidateColumns, group_totals, numpy
+
+
+class MoveLineRow(Mapping):
+    """ Read-only move line returned by a query
+
+    The row keeps the tuple of values returned by the cursor and the
+    positions of the columns, shared by all the rows of the query, so it
+    takes a fraction of the memory of the dict returned by
+    ``dictfetchall()``. It is read the same way, through the mapping
+    protocol.
+    """
+    __slots__ = ('_positions', '_values')
+
+    def __init__(self, positions, values):
+        self._positions = positions
+        self._values = values
+
+    def __getitem__(self, key):
+        return self._values[self._positions[key]]
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __repr__(self):
+        return 'MoveLineRow(%r)' % dict(self)
+
+    @staticmethod
+    def positions(description):
+        """ Return the positions of the columns of a cursor description """
+        return dict((desc[0], idx) for idx, desc in enumerate(description))
+
+    @classmethod
+    def fetchall(cls, cr):
+        """ Return the rows of the last query executed by a cursor """
+        positions = cls.positions(cr.description)
+        return [cls(positions, values) for values in cr.fetchall()]
+
+
+class CandidateSnapshot(object):
+    """ Unreconciled move lines of an account, loaded once and shared by
+    the methods of a reconciliation run
+
+    The lines reconciled by a method are discarded, so the next methods
+    only see the lines which are still unreconciled.
+
+    When ``columnar`` is set, the lines are kept in `CandidateColumns`
+    between the methods. The rows of the lines are built from the arrays
+    at the first read of ``lines`` and shared by the reads of a method,
+    until the reconciled lines are discarded.
+    """
+
+    def __init__(self, account_id, lines, columnar=False):
+        self.account_id = account_id
+        self.columns = None
+        self._lines = lines
+        if columnar:
+            self.columns = CandidateColumns(lines)
+            self._lines = None
+
+    @property
+    def lines(self):
+        if self.columns is not None and self._lines is None:
+            positions = dict(
+                (column, idx) for idx, column
+                in enumerate(CandidateColumns.row_columns)
+            )
+            self._lines = [MoveLineRow(positions, values)
+                           for values in self.columns.rows()]
+        return self._lines
+
+    def __len__(self):
+        if self.columns is not None:
+            return len(self.columns)
+        return len(self._lines)
+
+    def line_ids(self):
+        if self.columns is not None:
+            return self.columns.ids.tolist()
+        return [line['id'] for line in self._lines]
+
+    def discard(self, line_ids):
+        """ Remove the reconciled lines from the snapshot """
+        if not line_ids:
+            return
+        if self.columns is not None:
+            self.columns.discard(line_ids)
+            # the rows are built again by the next method
+            self._lines = None
+            return
+        line_ids = set(line_ids)
+        self._lines = [line for line in self._lines
+                       if line['id'] not in line_ids]
+
+
+class ReconcileStats(object):
+    """ Volume and timing metrics of a reconciliation method run
+
+    The timers are exclusive: when a timer is started while another one
+    is running, the time is only counted in the inner timer.
+    """
+    counters = ('lines_fetched', 'comparisons', 'groups',
+                'reconcile_calls', 'commits', 'reconciled_lines')
+    timers = ('query_time', 'matching_time', 'write_time')
+
+    def __init__(self):
+        for name in self.counters + self.timers:
+            setattr(self, name, 0)
+        self._running = []
+        self._started = None
+
+    @contextmanager
+    def timer(self, name):
+        now = time.time()
+        if self._running:
+            self._add(self._running[-1], now - self._started)
+        self._running.append(name)
+        self._started = now
+        try:
+            yield
+        finally:
+            now = time.time()
+            self._add(self._running.pop(), now - self._started)
+            self._started = now
+
+    def _add(self, name, value):
+        setattr(self, name, getattr(self, name) + value)
+
+    def merge(self, other):
+        """ Add the metrics of another run, of a shard as instance """
+        for name in self.counters + self.timers:
+            self._add(name, getattr(other, name))
+
+    def as_dict(self):
+        return dict((name, getattr(self, name))
+                    for name in self.counters + self.timers)
+
+    def count_lines(self, lines):
+        """ Count the lines of an iterable while they are consumed """
+        for line in lines:
+            self.lines_fetched += 1
+            yield line
+
+
+class ReconcileSimulation(object):
+    """ Reconciliations proposed by the methods of a simulated run
+
+    The groups of lines are recorded instead of being reconciled. As
+    the lines stay unreconciled, the lines of a proposal are excluded
+    from the candidates of the following groups and methods.
+    """
+
+    def __init__(self):
+        self.proposals = []
+        self.line_ids = set()
+
+    def overlaps(self, lines):
+        return any(line['id'] in self.line_ids for line in lines)
+
+    def exclude_proposed(self, lines):
+        """ Filter out the lines already proposed from an iterable """
+        return (line for line in lines if line['id'] not in self.line_ids)
+
+    def propose(self, method, account, lines, full, debit, credit, date,
+                writeoff_account):
+        line_ids = [line['id'] for line in lines]
+        self.line_ids.update(line_ids)
+        self.proposals.append({
+            'method': method,
+            'account_id': account.id,
+            'line_ids': line_ids,
+            'full': full,
+            'debit': debit,
+            'credit': credit,
+            'date': date,
+            'writeoff_account_id': writeoff_account.id,
+        })
+
 
 class MassReconcileBase(models.AbstractModel):
     """Abstract Model for reconciliation methods"""
     _name = 'mass.reconcile.base'
     _inherit = 'mass.reconcile.options'
 
+    # set to True when the method never matches lines of different
+    # partners, it can then run in parallel on shards of partners
+    _shard_by_partner = False
+    # minimum number of groups for which the totals are computed on
+    # NumPy arrays, below it the overhead of NumPy exceeds the gain
+    _columns_min_groups = 64
+    # maximum number of groups whose reconciliations are deferred before
+    # they are written, see `_defer_reconciliations`
+    _write_batch_size = 1000
+
     account_id = fields.Many2one(
         'account.account',
         string='Account',
@@ -23,6 +218,17 @@ class MassReconcileBase(models.AbstractModel):
         comodel_name='res.partner',
         string='Restrict on partners',
     )
+    changed_since = fields.Datetime(
+        string='Restrict on keys changed since',
+        help="Only the lines sharing their matching key with a line "
+             "created or modified after this date are reconciled.",
+    )
+    resume_from_id = fields.Integer(
+        string='Resume from credit line',
+        help="Id of the first credit line to inspect when an interrupted "
+             "run is resumed, the previous credit lines have been "
+             "processed.",
+    )
     # other fields are inherited from mass.reconcile.options
 
     @api.multi
@@ -63,6 +269,16 @@ class MassReconcileBase(models.AbstractModel):
     def _selection_columns(self):
         return self._base_columns()
 
+    def _incremental_key_field(self):
+        """ Field of the move lines which must be equal for the lines to
+        be matched together, used to restrict an incremental run on the
+        keys of the changed lines
+
+        :return: name of the field or None when the method cannot run
+                 incrementally
+        """
+        return None
+
     def _select_query(self, *args, **kwargs):
         return "SELECT %s" % ', '.join(self._selection_columns())
 
@@ -82,6 +298,16 @@ class MassReconcileBase(models.AbstractModel):
         if self.partner_ids:
             where += " AND account_move_line.partner_id IN %s"
             params.append(tuple([l.id for l in self.partner_ids]))
+        key_field = self._incremental_key_field()
+        if self.changed_since and key_field:
+            # only the keys of the lines changed since the last run can
+            # have new matches, the other ones have already been tried
+            where += (" AND account_move_line.{key} IN ("
+                      "SELECT changed.{key} FROM account_move_line changed "
+                      "WHERE changed.account_id = %s "
+                      "AND NOT changed.reconciled "
+                      "AND changed.write_date > %s)").format(key=key_field)
+            params += [self.account_id.id, self.changed_since]
         return where, params
 
     @api.multi
@@ -97,6 +323,131 @@ class MassReconcileBase(models.AbstractModel):
                 where = " AND %s" % where
         return where, params
 
+    def _get_stats(self):
+        """ Return the `ReconcileStats` collecting the metrics of the run
+
+        When the run does not collect metrics, a new instance is returned
+        so the counters can always be incremented.
+        """
+        stats = self.env.context.get('mass_reconcile_stats')
+        if stats is None:
+            stats = ReconcileStats()
+        return stats
+
+    def _get_simulation(self):
+        """ Return the `ReconcileSimulation` of a simulated run, None
+        when the lines are really reconciled
+        """
+        return self.env.context.get('mass_reconcile_simulation')
+
+    @api.multi
+    def _get_commit_every(self):
+        """ Number of groups reconciled between two commits, 0 to never
+        commit during the run
+        """
+        self.ensure_one()
+        if self._get_simulation() is not None:
+            return 0
+        return self.account_id.company_id.reconciliation_commit_every
+
+    @api.multi
+    def _checkpoint(self, move_line_ids, resume_from_id=None):
+        """ Record the progress of the run before a commit
+
+        The reconciliations of ``move_line_ids`` are added to the history
+        of the run, with the id of the credit line from which the method
+        would be resumed, so an interrupted run restarts from there.
+
+        :param list move_line_ids: ids of the lines reconciled since the
+                                   previous checkpoint
+        :param int resume_from_id: see ``resume_from_id``
+        """
+        history_id = self.env.context.get('mass_reconcile_history_id')
+        if not history_id:
+            return
+        history = self.env['mass.reconcile.history'].browse(history_id)
+        history._record_progress(move_line_ids,
+                                 resume_from_id=resume_from_id)
+
+    @api.multi
+    def _get_snapshot(self):
+        """ Return the `CandidateSnapshot` of the run when the lines of
+        this method can be read from it, None otherwise
+
+        The snapshot only contains the base columns without filter, so
+        it is not used when the method has a filter, is restricted on
+        partners or changed keys or selects other columns.
+        """
+        self.ensure_one()
+        snapshot = self.env.context.get('mass_reconcile_snapshot')
+        if (snapshot is None or
+                snapshot.account_id != self.account_id.id or
+                self._filter or self.partner_ids or self.changed_since or
+                self._selection_columns() != self._base_columns()):
+            return None
+        return snapshot
+
+    @api.multi
+    def _fetch_lines(self, query, params):
+        """ Execute a query selecting move lines
+
+        When a fetch chunk size is configured on the company, the lines
+        are read by chunks through a server-side cursor and returned as
+        an iterator, so the query does not load all the lines at once.
+        The memory of a method still depends on what it keeps from the
+        iterator: the simple methods only keep the lines of the current
+        key, the advanced methods keep all the debit lines, which are
+        indexed, and the matched credit lines.
+        The iterator has to be consumed before the transaction is
+        committed.
+
+        :return: iterable of `MoveLineRow`
+        """
+        self.ensure_one()
+        company = self.account_id.company_id
+        chunk_size = company.reconciliation_fetch_chunk_size
+        stats = self._get_stats()
+        simulation = self._get_simulation()
+        if not chunk_size:
+            with stats.timer('query_time'):
+                self.env.cr.execute(query, params)
+                lines = MoveLineRow.fetchall(self.env.cr)
+            if simulation is not None:
+                lines = list(simulation.exclude_proposed(lines))
+            stats.lines_fetched += len(lines)
+            return lines
+        lines = self._iter_lines(query, params, chunk_size)
+        if simulation is not None:
+            lines = simulation.exclude_proposed(lines)
+        return stats.count_lines(lines)
+
+    def _iter_lines(self, query, params, chunk_size):
+        """ Yield the lines of a query read by chunks of ``chunk_size``
+        lines through a server-side cursor
+        """
+        # the cursor is declared in SQL in the transaction of the
+        # environment cursor, which can run other queries between two
+        # fetches. When the iterator is not consumed, the cursor is
+        # closed at the end of the transaction.
+        stats = self._get_stats()
+        cr = self.env.cr
+        name = 'mass_reconcile_%s' % uuid4().hex
+        with stats.timer('query_time'):
+            cr.execute('DECLARE "%s" NO SCROLL CURSOR FOR %s'
+                       % (name, query), params)
+        positions = None
+        while True:
+            with stats.timer('query_time'):
+                cr.execute('FETCH FORWARD %d FROM "%s"' % (chunk_size, name))
+                rows = cr.fetchall()
+            if not rows:
+                break
+            if positions is None:
+                positions = MoveLineRow.positions(cr.description)
+            for row in rows:
+                yield MoveLineRow(positions, row)
+        cr.execute('CLOSE "%s"' % name)
+
     @api.multi
     def _below_writeoff_limit(self, lines, writeoff_limit):
         self.ensure_one()
@@ -112,6 +463,67 @@ class MassReconcileBase(models.AbstractModel):
         writeoff_amount = round(debit - credit, precision)
         return bool(writeoff_limit >= abs(writeoff_amount)), debit, credit
 
+    @api.multi
+    def _use_columns(self):
+        """ Return True when the computations on the lines are done on
+        NumPy arrays
+        """
+        self.ensure_one()
+        return bool(numpy is not None and
+                    self.account_id.company_id.reconciliation_columnar)
+
+    @api.multi
+    def _group_totals(self, groups, allow_partial=False):
+        """ Compute the totals of several groups of lines
+
+        With the columnar representation, the totals of the batches of at
+        least ``_columns_min_groups`` groups are computed at once on NumPy
+        arrays, read from the snapshot when the lines come from it.
+
+        :param list groups: list of list of dict of move lines
+        :param boolean allow_partial: see `_reconcile_lines`, the date is
+                                      only computed for the groups which
+                                      can be reconciled
+        :return: list of tuples (below write-off, debit, credit,
+                 reconciliation date) for each group
+        """
+        self.ensure_one()
+        if not (len(groups) >= self._columns_min_groups and
+                self._use_columns()):
+            results = []
+            for lines in groups:
+                below_writeoff, sum_debit, sum_credit = \
+                    self._below_writeoff_limit(lines, self.write_off)
+                rec_date = None
+                if below_writeoff or allow_partial:
+                    rec_date = self._get_rec_date(lines, self.date_base_on)
+                results.append((below_writeoff, sum_debit, sum_credit,
+                                rec_date))
+            return results
+        precision = self.env['decimal.precision'].precision_get('Account')
+        lines = [line for group in groups for line in group]
+        lengths = [len(group) for group in groups]
+        snapshot = self._get_snapshot()
+        positions = None
+        if snapshot is not None and snapshot.columns is not None:
+            columns = snapshot.columns
+            positions = columns.positions([line['id'] for line in lines])
+        if positions is not None:
+            debit = columns.debit[positions]
+            credit = columns.credit[positions]
+            dates = columns.date[positions]
+        else:
+            count = len(lines)
+            debit = numpy.fromiter(
+                (line['debit'] for line in lines), numpy.float64, count)
+            credit = numpy.fromiter(
+                (line['credit'] for line in lines), numpy.float64, count)
+            dates = numpy.fromiter(
+                (line['date'].toordinal() for line in lines), numpy.int64,
+                count)
+        return group_totals(debit, credit, dates, lengths, self.write_off,
+                            precision, self.date_base_on)
+
     @api.multi
     def _get_rec_date(self, lines, based_on='end_period_last_credit'):
         self.ensure_one()
@@ -150,39 +562,147 @@ class MassReconcileBase(models.AbstractModel):
                  or partial (False)
         """
         self.ensure_one()
-        ml_obj = self.env['account.move.line']
-        below_writeoff, sum_debit, sum_credit = self._below_writeoff_limit(
-            lines, self.write_off
-        )
-        rec_date = self._get_rec_date(lines, self.date_base_on)
-        line_rs = ml_obj.browse([l['id'] for l in lines]).with_context(
-            date_p=rec_date,
-            comment=_('Automatic Write Off'))
-        if below_writeoff:
-            if sum_credit > sum_debit:
-                writeoff_account = self.account_profit_id
-            else:
-                writeoff_account = self.account_lost_id
-            line_rs.reconcile(
-                writeoff_acc_id=writeoff_account,
-                writeoff_journal_id=self.journal_id
-            )
-            return True, True
-        elif allow_partial:
-            # We need to give a writeoff_acc_id
-            # in case we have a multi currency lines
-            # to reconcile.
-            # If amount in currency is equal between
-            # lines to reconcile
-            # it will do a full reconcile instead of a partial reconcile
-            # and make a write-off for exchange
-            if sum_credit > sum_debit:
-                writeoff_account = self.income_exchange_account_id
+        return self._reconcile_groups([lines], allow_partial=allow_partial)[0]
+
+    @api.multi
+    def _reconcile_groups(self, groups, allow_partial=False):
+        """ Try to reconcile several groups of lines
+
+        The totals of the groups are computed by `_group_totals` and the
+        groups which can be reconciled are written by
+        `_write_reconciliations`, or later by `_defer_reconciliations`
+        when the caller defers them. In a simulated run, the groups are
+        recorded in the `ReconcileSimulation` instead.
+
+        :param list groups: list of list of dict of move lines, see
+                            `_reconcile_lines`
+        :param boolean allow_partial: see `_reconcile_lines`
+        :return: list of tuples of boolean values for each group, see
+                 `_reconcile_lines`
+        """
+        self.ensure_one()
+        stats = self._get_stats()
+        simulation = self._get_simulation()
+        results = []
+        reconciliations = []
+        with stats.timer('write_time'):
+            totals = self._group_totals(groups, allow_partial=allow_partial)
+            for lines, (below_writeoff, sum_debit, sum_credit,
+                        rec_date) in zip(groups, totals):
+                if not (below_writeoff or allow_partial):
+                    results.append((False, False))
+                    continue
+                if simulation is not None and simulation.overlaps(lines):
+                    # a line is already in a proposed reconciliation
+                    results.append((False, False))
+                    continue
+                if below_writeoff:
+                    if sum_credit > sum_debit:
+                        writeoff_account = self.account_profit_id
+                    else:
+                        writeoff_account = self.account_lost_id
+                else:
+                    # We need to give a writeoff_acc_id
+                    # in case we have a multi currency lines
+                    # to reconcile.
+                    # If amount in currency is equal between
+                    # lines to reconcile
+                    # it will do a full reconcile instead of a partial
+                    # reconcile and make a write-off for exchange
+                    if sum_credit > sum_debit:
+                        writeoff_account = self.income_exchange_account_id
+                    else:
+                        writeoff_account = self.expense_exchange_account_id
+                if simulation is not None:
+                    simulation.propose(self._name, self.account_id, lines,
+                                       below_writeoff, sum_debit,
+                                       sum_credit, rec_date,
+                                       writeoff_account)
+                else:
+                    reconciliations.append(
+                        ([l['id'] for l in lines], writeoff_account,
+                         rec_date)
+                    )
+                results.append((True, below_writeoff))
+            deferred = self.env.context.get('mass_reconcile_deferred')
+            if deferred is None:
+                self._write_reconciliations(reconciliations)
             else:
-                writeoff_account = self.expense_exchange_account_id
+                deferred += reconciliations
+                if len(deferred) >= self._write_batch_size:
+                    self._write_reconciliations(deferred)
+                    del deferred[:]
+        return results
+
+    @api.multi
+    @contextmanager
+    def _defer_reconciliations(self):
+        """ Defer the writes of the reconciliations of `_reconcile_groups`
+        to write them in batches of `_write_batch_size` groups
+
+        The methods reconciling one group at a time use it, so the lines
+        of a batch are prefetched together by `_write_reconciliations`.
+        The groups still waiting are written when the block ends. The
+        result of `_reconcile_groups` only depends on the totals of the
+        groups, so it is known before the groups are written.
+
+        :yield: the method with the context deferring the writes
+        """
+        self.ensure_one()
+        deferred = []
+        yield self.with_context(mass_reconcile_deferred=deferred)
+        with self._get_stats().timer('write_time'):
+            self._write_reconciliations(deferred)
+
+    @api.multi
+    def _write_reconciliations(self, reconciliations):
+        """ Reconcile groups of move lines
+
+        The move lines of all the groups are browsed in one recordset, so
+        their values are prefetched together instead of once per group.
+        Each group is reconciled by `account.move.line.reconcile()`, so
+        the write-off and exchange difference entries, and the overrides
+        of `reconcile()`, are the same as when the groups are reconciled
+        one by one.
+
+        :param list reconciliations: list of tuples (move line ids,
+                                     write-off account, reconciliation
+                                     date or None for today)
+        """
+        self.ensure_one()
+        if not reconciliations:
+            return
+        stats = self._get_stats()
+        all_line_rs = self.env['account.move.line'].browse(
+            [lid for line_ids, dummy, dummy in reconciliations
+             for lid in line_ids]
+        ).with_context(comment=_('Automatic Write Off'))
+        for line_ids, writeoff_account, rec_date in reconciliations:
+            # browsing from the recordset of all the lines keeps
+            # their prefetching
+            line_rs = all_line_rs.browse(line_ids).with_context(
+                date_p=rec_date)
+            stats.reconcile_calls += 1
             line_rs.reconcile(
                 writeoff_acc_id=writeoff_account,
                 writeoff_journal_id=self.journal_id
             )
-            return True, False
-        return False, False
+
+    @api.multi
+    def _reconcile_proposals(self, proposals):
+        """ Reconcile the groups proposed by a simulated run of the
+        method, see `ReconcileSimulation`
+
+        :return: list of the ids of the fully reconciled lines
+        """
+        self.ensure_one()
+        account_obj = self.env['account.account']
+        with self._get_stats().timer('write_time'):
+            self._write_reconciliations([
+                (proposal['line_ids'],
+                 account_obj.browse(proposal['writeoff_account_id']),
+                 proposal['date'])
+                for proposal in proposals
+            ])
+        return [line_id for proposal in proposals if proposal['full']
+                for line_id in proposal['line_ids']]
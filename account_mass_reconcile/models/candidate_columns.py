@@ -0,0 +1,144 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from datetime import date
+import logging
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except (ImportError, IOError) as err:
+    _logger.debug(err)
+    numpy = None
+
+
+class CandidateColumns(object):
+    """ Move lines stored as NumPy arrays, one array per base column
+
+    The dates are stored as ordinals, the missing partners as -1 and the
+    references and labels as codes of a shared list of the distinct
+    values, so a line takes a few dozens of bytes instead of a dict.
+    The lines must be sorted by id, as the lines of a snapshot are.
+
+    :param list lines: dict of move lines with the base columns
+    """
+
+    _arrays = ('ids', 'debit', 'credit', 'date', 'partner', 'account',
+               'move', 'reconciled', 'ref', 'name')
+
+    def __init__(self, lines):
+        count = len(lines)
+        self._values = [None]
+        self._codes = {None: 0}
+        self.ids = numpy.fromiter(
+            (line['id'] for line in lines), numpy.int64, count)
+        self.debit = numpy.fromiter(
+            (line['debit'] for line in lines), numpy.float64, count)
+        self.credit = numpy.fromiter(
+            (line['credit'] for line in lines), numpy.float64, count)
+        self.date = numpy.fromiter(
+            (line['date'].toordinal() for line in lines), numpy.int64, count)
+        self.partner = numpy.fromiter(
+            (line['partner_id'] or -1 for line in lines), numpy.int64, count)
+        self.account = numpy.fromiter(
+            (line['account_id'] for line in lines), numpy.int64, count)
+        self.move = numpy.fromiter(
+            (line['move_id'] for line in lines), numpy.int64, count)
+        self.reconciled = numpy.fromiter(
+            (line['reconciled'] for line in lines), numpy.bool_, count)
+        self.ref = numpy.fromiter(
+            (self._intern(line['ref']) for line in lines), numpy.int32, count)
+        self.name = numpy.fromiter(
+            (self._intern(line['name']) for line in lines), numpy.int32,
+            count)
+
+    def _intern(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._values)
+            self._values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.ids)
+
+    def discard(self, line_ids):
+        """ Remove lines from the arrays """
+        keep = ~numpy.isin(self.ids, numpy.asarray(line_ids, numpy.int64))
+        for name in self._arrays:
+            setattr(self, name, getattr(self, name)[keep])
+
+    # columns of the tuples returned by `rows`
+    row_columns = ('id', 'debit', 'credit', 'date', 'ref', 'name',
+                   'partner_id', 'account_id', 'reconciled', 'move_id')
+
+    def rows(self):
+        """ Return the lines as tuples of the values of ``row_columns`` """
+        values = self._values
+        partners = [partner if partner >= 0 else None
+                    for partner in self.partner.tolist()]
+        return [
+            (id_, debit, credit, date.fromordinal(ordinal), values[ref],
+             values[name], partner, account, reconciled, move)
+            for (id_, debit, credit, ordinal, ref, name, partner, account,
+                 reconciled, move)
+            in zip(self.ids.tolist(), self.debit.tolist(),
+                   self.credit.tolist(), self.date.tolist(),
+                   self.ref.tolist(), self.name.tolist(), partners,
+                   self.account.tolist(), self.reconciled.tolist(),
+                   self.move.tolist())
+        ]
+
+    def positions(self, line_ids):
+        """ Return the positions of lines in the arrays, None when a line
+        is not in the arrays
+        """
+        line_ids = numpy.asarray(line_ids, numpy.int64)
+        positions = numpy.searchsorted(self.ids, line_ids)
+        if (positions >= len(self.ids)).any():
+            return None
+        if (self.ids[positions] != line_ids).any():
+            return None
+        return positions
+
+
+def group_totals(debit, credit, dates, lengths, writeoff_limit, precision,
+                 based_on):
+    """ Compute the totals of groups of lines at once
+
+    The arrays contain the values of the lines of all the groups, one
+    group after the other.
+
+    :param debit: array of the debits of the lines
+    :param credit: array of the credits of the lines
+    :param dates: array of the dates of the lines, as ordinals
+    :param list lengths: number of lines of each group
+    :param float writeoff_limit: maximum write-off of a full reconciliation
+    :param int precision: number of digits of the amounts
+    :param str based_on: see `mass.reconcile.options.date_base_on`
+    :return: list of tuples (below write-off, debit, credit, reconciliation
+             date) for each group, the date is None when the reconciliation
+             is done at the date of the run
+    """
+    starts = numpy.zeros(len(lengths), numpy.int64)
+    numpy.cumsum(lengths[:-1], out=starts[1:])
+    sum_debit = numpy.add.reduceat(debit, starts)
+    sum_credit = numpy.add.reduceat(credit, starts)
+    writeoff = numpy.round(sum_debit - sum_credit, precision)
+    below_writeoff = numpy.abs(writeoff) <= writeoff_limit
+    if based_on == 'newest':
+        rec_dates = numpy.maximum.reduceat(dates, starts).tolist()
+    elif based_on in ('newest_credit', 'newest_debit'):
+        amounts = credit if based_on == 'newest_credit' else debit
+        rec_dates = numpy.maximum.reduceat(
+            numpy.where(amounts > 0, dates, -1), starts).tolist()
+    else:
+        rec_dates = [-1] * len(lengths)
+    return [
+        (below, total_debit, total_credit,
+         date.fromordinal(ordinal) if ordinal > 0 else None)
+        for below, total_debit, total_credit, ordinal
+        in zip(below_writeoff.tolist(), sum_debit.tolist(),
+               sum_credit.tolist(), rec_dates)
+    ]
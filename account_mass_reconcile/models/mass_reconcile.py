@@ -2,15 +2,76 @@
 # Copyright 2010 Sébastien Beau
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
-from datetime import datetime
+from datetime import timedelta
+import heapq
+from itertools import groupby
 import logging
+import multiprocessing
+from operator import itemgetter
+import signal
+import time
 
 from odoo import models, api, fields, _
-from odoo.exceptions import Warning as UserError
+from odoo.exceptions import ValidationError, Warning as UserError
 from odoo import sql_db
+from odoo.modules.registry import Registry
+from odoo.service import server as odoo_server
+
+from .base_reconciliation import (
+    CandidateSnapshot, MoveLineRow, ReconcileSimulation, ReconcileStats
+)
+from .candidate_columns import numpy
 
 _logger = logging.getLogger(__name__)
 
+# connection pools inherited by the processes matching the shards, kept
+# referenced so their connections, still used by the parent process, are
+# never closed by the child
+_inherited_pools = []
+
+
+def _init_shard_process(dbname):
+    """ Initialize a process of the pool matching the shards of a
+    sharded run, forked from the worker running the task
+
+    The connections of the worker are set aside and the registry gets a
+    new connection pool, the signal handlers of the worker are reset.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    _inherited_pools.append(sql_db._Pool)
+    sql_db._Pool = None
+    api.Environment.reset()
+    Registry(dbname)._db = sql_db.db_connect(dbname)
+
+
+def _match_shard(args):
+    """ Match the lines of a shard in a process of the pool, see
+    `AccountMassReconcile._match_shard`
+
+    The shard is matched in a new cursor, rolled back at the end.
+
+    :param tuple args: database name, user id, context, task id, method
+                       id, account id, partner ids of the shard or None,
+                       watermark of an incremental run
+    :return: tuple (proposals of the `ReconcileSimulation`,
+                    `ReconcileStats`)
+    """
+    (dbname, uid, context, task_id, method_id, account_id, partner_ids,
+     changed_since) = args
+    with api.Environment.manage():
+        cr = Registry(dbname).cursor()
+        try:
+            env = api.Environment(cr, uid, context)
+            return env['account.mass.reconcile'].browse(task_id)._match_shard(
+                env['account.mass.reconcile.method'].browse(method_id),
+                env['account.account'].browse(account_id),
+                partner_ids, changed_since
+            )
+        finally:
+            cr.rollback()
+            cr.close()
+
 
 class MassReconcileOptions(models.AbstractModel):
     """Options of a reconciliation profile
@@ -63,6 +124,13 @@ class MassReconcileOptions(models.AbstractModel):
         'account.account',
         string='Loss Exchange Rate Account',
     )
+    pair_in_database = fields.Boolean(
+        string='Pair in database',
+        help="Simple methods only: the debit and credit lines having the "
+             "same key and the same amount are paired by the database, "
+             "only the pairs are loaded. Lines with different amounts "
+             "are not paired, even within the write-off.",
+    )
 
 
 class AccountMassReconcileMethod(models.Model):
@@ -78,8 +146,12 @@ class AccountMassReconcileMethod(models.Model):
             ('mass.reconcile.simple.partner', 'Simple. Amount and Partner'),
             ('mass.reconcile.simple.reference',
              'Simple. Amount and Reference'),
+            ('mass.reconcile.simple.partner.closest',
+             'Simple. Closest Amount and Partner'),
             ('mass.reconcile.advanced.ref',
              'Advanced. Partner and Ref.'),
+            ('mass.reconcile.subset.partner',
+             'Advanced. Partner and Sum of Amounts'),
         ]
 
     def _selection_name(self):
@@ -110,43 +182,132 @@ class AccountMassReconcileMethod(models.Model):
         readonly=True,
     )
 
+    @api.model
+    def create(self, vals):
+        method = super(AccountMassReconcileMethod, self).create(vals)
+        method.task_id._reset_watermark()
+        return method
+
+    @api.multi
+    def write(self, vals):
+        tasks = self.mapped('task_id')
+        res = super(AccountMassReconcileMethod, self).write(vals)
+        (tasks | self.mapped('task_id'))._reset_watermark()
+        return res
+
+    @api.multi
+    def unlink(self):
+        tasks = self.mapped('task_id')
+        res = super(AccountMassReconcileMethod, self).unlink()
+        tasks._reset_watermark()
+        return res
+
 
 class AccountMassReconcile(models.Model):
     _name = 'account.mass.reconcile'
     _inherit = ['mail.thread']
     _description = 'account mass reconcile'
 
+    # unreconciled counts by (database, account): (expiry, count), so
+    # repeated renders of the task list skip the database
+    _unreconciled_count_cache = {}
+    _unreconciled_count_ttl = 30
+
+    @api.model
+    def _get_unreconciled_counts(self, account_ids):
+        """ Count the unreconciled lines of accounts in one query
+
+        :return: dict account id: number of unreconciled lines
+        """
+        dbname = self.env.cr.dbname
+        now = time.time()
+        counts = {}
+        missing = []
+        for account_id in account_ids:
+            cached = self._unreconciled_count_cache.get((dbname, account_id))
+            if cached and cached[0] > now:
+                counts[account_id] = cached[1]
+            else:
+                missing.append(account_id)
+        if missing:
+            self.env.cr.execute(
+                "SELECT account_id, count(*) FROM account_move_line "
+                "WHERE account_id IN %s AND NOT reconciled "
+                "GROUP BY account_id",
+                (tuple(missing),)
+            )
+            fetched = dict(self.env.cr.fetchall())
+            expiry = now + self._unreconciled_count_ttl
+            for account_id in missing:
+                counts[account_id] = fetched.get(account_id, 0)
+                self._unreconciled_count_cache[(dbname, account_id)] = (
+                    expiry, counts[account_id]
+                )
+        return counts
+
+    @api.multi
+    def _invalidate_unreconciled_count(self):
+        dbname = self.env.cr.dbname
+        accounts = self.mapped('account') | self.mapped('account_ids')
+        for account_id in accounts.ids:
+            self._unreconciled_count_cache.pop((dbname, account_id), None)
+
     @api.multi
-    @api.depends('account', 'history_ids')
+    @api.depends('profile_type', 'account', 'account_ids', 'history_ids')
     def _get_total_unrec(self):
-        obj_move_line = self.env['account.move.line']
+        accounts = self.mapped('account') | self.mapped('account_ids')
+        counts = self._get_unreconciled_counts(accounts.ids)
         for rec in self:
-            rec.unreconciled_count = obj_move_line.search_count(
-                [('account_id', '=', rec.account.id),
-                 ('reconciled', '=', False)])
+            rec.unreconciled_count = sum(
+                counts.get(account_id, 0)
+                for account_id in rec._get_accounts().ids
+            )
 
     @api.multi
     @api.depends('history_ids')
     def _last_history(self):
-        # do a search() for retrieving the latest history line,
-        # as a read() will badly split the list of ids with 'date desc'
-        # and return the wrong result.
+        task_ids = tuple(id_ for id_ in self.ids if id_)
+        last_history_ids = {}
+        if task_ids:
+            self.env.cr.execute(
+                "SELECT DISTINCT ON (mass_reconcile_id) "
+                "       mass_reconcile_id, id "
+                "FROM mass_reconcile_history "
+                "WHERE mass_reconcile_id IN %s "
+                "ORDER BY mass_reconcile_id, date DESC, id DESC",
+                (task_ids,)
+            )
+            last_history_ids = dict(self.env.cr.fetchall())
         history_obj = self.env['mass.reconcile.history']
         for rec in self:
-            last_history_rs = history_obj.search(
-                [('mass_reconcile_id', '=', rec.id)],
-                limit=1, order='date desc'
-                )
-            rec.last_history = last_history_rs or False
+            rec.last_history = history_obj.browse(
+                last_history_ids.get(rec.id)
+            )
 
     name = fields.Char(
         string='Name',
         required=True,
     )
+    profile_type = fields.Selection(
+        [('single', 'Single Account'),
+         ('multi', 'Multiple Accounts')],
+        string='Profile Type',
+        required=True,
+        default='single',
+        help="A profile on multiple accounts runs its methods on each "
+             "account, the candidate lines of all the accounts being "
+             "loaded in one query, and records one history per run.",
+    )
     account = fields.Many2one(
         'account.account',
         string='Account',
-        required=True,
+    )
+    account_ids = fields.Many2many(
+        'account.account',
+        relation='account_mass_reconcile_account_rel',
+        column1='mass_reconcile_id',
+        column2='account_id',
+        string='Accounts',
     )
     reconcile_method = fields.One2many(
         'account.mass.reconcile.method',
@@ -172,10 +333,105 @@ class AccountMassReconcile(models.Model):
         'res.company',
         string='Company',
     )
+    resume_interrupted = fields.Boolean(
+        string='Resume Interrupted Runs',
+        help="When the last run failed or was interrupted, the next run "
+             "resumes it from its checkpoint, skipping the methods "
+             "already done. Otherwise, the next run starts again from "
+             "the first method.",
+    )
+    incremental = fields.Boolean(
+        string='Incremental',
+        help="Only reconcile the lines sharing their partner, name or "
+             "reference (according to the method) with a line created "
+             "or modified since the previous run. A full run is still "
+             "done at the configured interval.",
+    )
+    full_run_interval = fields.Integer(
+        string='Full Run Interval (days)',
+        default=7,
+        help="Number of days between two full runs of an incremental "
+             "task. Leave zero to never force a full run.",
+    )
+    watermark = fields.Datetime(
+        string='Watermark',
+        readonly=True,
+        copy=False,
+        help="Start of the previous run, less the overlap, the lines "
+             "changed after this date are reconciled by the next "
+             "incremental run.",
+    )
+    watermark_overlap = fields.Integer(
+        string='Watermark Overlap (minutes)',
+        default=5,
+        help="The watermark is set this number of minutes before the "
+             "start of the run, or of the oldest transaction running at "
+             "that time. A line is dated by the start of the transaction "
+             "writing it, which can be committed after the start of the "
+             "run: the overlap covers the transactions ending after it.",
+    )
+    last_full_run = fields.Datetime(
+        string='Last Full Run',
+        readonly=True,
+        copy=False,
+    )
+    shard_workers = fields.Integer(
+        string='Parallel Workers',
+        help="When greater than 1, the methods matching on the partner "
+             "are split in this number of shards of partners. The "
+             "reconciliations are written one shard after the other. "
+             "The shards are matched by as many processes when the "
+             "parallel processes are enabled in the settings, one after "
+             "the other by the worker otherwise.",
+    )
+    scheduler_weight = fields.Float(
+        string='Scheduler Weight',
+        default=1.0,
+        help="Multiplies the priority of the task in the scheduler, "
+             "which runs first the tasks with the most unreconciled "
+             "items and the longest time since their last run.",
+    )
+    claimed_by = fields.Char(
+        string='Claimed By',
+        compute='_compute_claimed_by',
+        help="Database connection of the worker running the task.",
+    )
+
+    @api.multi
+    @api.constrains('profile_type', 'account', 'account_ids')
+    def _check_accounts(self):
+        for rec in self:
+            if rec.profile_type == 'single' and not rec.account:
+                raise ValidationError(
+                    _('The profile %s has no account.') % rec.name
+                )
+            if rec.profile_type == 'multi' and not rec.account_ids:
+                raise ValidationError(
+                    _('The profile %s has no accounts.') % rec.name
+                )
+
+    @api.multi
+    def write(self, vals):
+        res = super(AccountMassReconcile, self).write(vals)
+        if any(field in vals
+               for field in ('profile_type', 'account', 'account_ids')):
+            # the lines of the new accounts have never been reconciled
+            self._reset_watermark()
+        return res
+
+    @api.multi
+    def _get_accounts(self):
+        """ Return the accounts reconciled by the profile """
+        self.ensure_one()
+        if self.profile_type == 'multi':
+            return self.account_ids
+        return self.account
 
     @staticmethod
-    def _prepare_run_transient(rec_method):
-        return {'account_id': rec_method.task_id.account.id,
+    def _prepare_run_transient(rec_method, account=None):
+        if account is None:
+            account = rec_method.task_id.account
+        return {'account_id': account.id,
                 'write_off': rec_method.write_off,
                 'account_lost_id': (rec_method.account_lost_id.id),
                 'account_profit_id': (rec_method.account_profit_id.id),
@@ -185,85 +441,656 @@ class AccountMassReconcile(models.Model):
                 (rec_method.income_exchange_account_id.id),
                 'journal_id': (rec_method.journal_id.id),
                 'date_base_on': rec_method.date_base_on,
+                'pair_in_database': rec_method.pair_in_database,
                 '_filter': rec_method._filter}
 
     @api.multi
-    def run_reconcile(self):
-        def find_reconcile_ids(fieldname, move_line_ids):
-            if not move_line_ids:
-                return []
-            sql = ("SELECT DISTINCT " + fieldname +
-                   " FROM account_move_line "
-                   " WHERE id in %s "
-                   " AND " + fieldname + " IS NOT NULL")
-            self.env.cr.execute(sql, (tuple(move_line_ids),))
-            res = self.env.cr.fetchall()
-            return [row[0] for row in res]
-
-        # we use a new cursor to be able to commit the reconciliation
-        # often. We have to create it here and not later to avoid problems
-        # where the new cursor sees the lines as reconciles but the old one
-        # does not.
+    def _find_reconcile_ids(self, fieldname, move_line_ids):
+        if not move_line_ids:
+            return []
+        sql = ("SELECT DISTINCT " + fieldname +
+               " FROM account_move_line "
+               " WHERE id in %s "
+               " AND " + fieldname + " IS NOT NULL")
+        self.env.cr.execute(sql, (tuple(move_line_ids),))
+        res = self.env.cr.fetchall()
+        return [row[0] for row in res]
+
+    @api.multi
+    def _create_history(self, move_line_ids, method_stats=None,
+                        history=None, failed=False):
+        """ Create the history of a run with the full reconciliations of
+        the given move lines
+
+        :param list method_stats: list of tuples (method, `ReconcileStats`,
+                                  account) of the methods which ran
+        :param history: history of the run created by `_start_history`,
+                        completed instead of creating a new one
+        :param failed: True when the run failed, its history keeps the
+                       checkpoint from which it can be resumed
+        """
+        self.ensure_one()
+        if history is None:
+            history = self._start_history()
+        stat_vals = []
+        first_sequence = len(history.stat_ids)
+        for sequence, (method, stats, account) in enumerate(
+                method_stats or [], start=first_sequence):
+            vals = stats.as_dict()
+            vals.update({
+                'sequence': sequence,
+                'method_id': method.id,
+                'name': method.name,
+                'account_id': account.id,
+            })
+            stat_vals.append((0, 0, vals))
+        history._record_progress(move_line_ids)
+        vals = {'state': 'failed' if failed else 'done',
+                'stat_ids': stat_vals}
+        if not failed:
+            vals.update({
+                'checkpoint_account_id': False,
+                'checkpoint_method_id': False,
+                'checkpoint_position': 0,
+            })
+        history.write(vals)
+        return history
+
+    @api.multi
+    def _start_history(self):
+        """ Create the history of a run before its methods run, so the
+        reconciliations can be added at each commit
+        """
+        self.ensure_one()
+        return self.env['mass.reconcile.history'].create({
+            'mass_reconcile_id': self.id,
+            'date': fields.Datetime.now(),
+            'state': 'running',
+        })
+
+    @api.multi
+    def _get_run_steps(self):
+        """ Return the tuples (account, method) run by the profile, in
+        order: all the methods run on an account before the next one
+        """
+        self.ensure_one()
+        return [(account, method)
+                for account in self._get_accounts()
+                for method in self.reconcile_method]
+
+    @api.multi
+    def _get_interrupted_history(self):
+        """ Return the history of the last run when it failed or was
+        interrupted, see `_resume_or_start_history`
+        """
+        self.ensure_one()
+        return self.env['mass.reconcile.history'].search(
+            [('mass_reconcile_id', '=', self.id)],
+            limit=1, order='date desc, id desc'
+        ).filtered(lambda history: history.state in ('running', 'failed'))
+
+    @api.multi
+    def _resume_or_start_history(self):
+        """ Return the history of the run
+
+        The last run, when it failed or was interrupted, is only resumed
+        when the task resumes the interrupted runs. Otherwise, a run
+        interrupted while running is closed as failed and a new run
+        starts from the first method.
+        """
+        self.ensure_one()
+        history = self._get_interrupted_history()
+        if history and self.resume_interrupted:
+            _logger.info("Resume the interrupted run of the reconcile task "
+                         "%s of %s", self.name, history.date)
+            self.message_post(
+                body=_("The interrupted run of %s is resumed.")
+                % history.date
+            )
+            history.state = 'running'
+            return history
+        if history.state == 'running':
+            _logger.warning("The run of the reconcile task %s of %s was "
+                            "interrupted, it is not resumed", self.name,
+                            history.date)
+            history.state = 'failed'
+        return self._start_history()
 
+    @api.multi
+    def _get_candidate_snapshot(self):
+        """ Load the unreconciled lines of the account once for all the
+        methods of a run
+
+        :return: a `CandidateSnapshot`
+        """
+        self.ensure_one()
+        return self._get_candidate_snapshots(self.account)[self.account.id]
+
+    @api.multi
+    def _get_candidate_snapshots(self, accounts):
+        """ Load the unreconciled lines of several accounts in one query,
+        once for all the methods of a run
+
+        :return: dict account id: `CandidateSnapshot`
+        """
+        self.ensure_one()
+        columns = self.env['mass.reconcile.base']._base_columns()
+        self.env.cr.execute(
+            "SELECT %s FROM account_move_line "
+            "WHERE account_move_line.account_id IN %%s "
+            "AND NOT account_move_line.reconciled "
+            "ORDER BY account_move_line.account_id, account_move_line.id"
+            % ', '.join(columns),
+            (tuple(accounts.ids),)
+        )
+        lines_by_account = dict(
+            (account_id, list(lines)) for account_id, lines in groupby(
+                MoveLineRow.fetchall(self.env.cr),
+                key=itemgetter('account_id'))
+        )
+        snapshots = {}
+        for account in accounts:
+            columnar = bool(numpy is not None and
+                            account.company_id.reconciliation_columnar)
+            snapshots[account.id] = CandidateSnapshot(
+                account.id, lines_by_account.get(account.id, []),
+                columnar=columnar
+            )
+        return snapshots
+
+    @api.model
+    def _discard_reconciled(self, snapshot, move_line_ids):
+        """ Remove the lines reconciled by a method from the snapshot
+
+        The methods only return the lines of their full reconciliations,
+        a line whose residual is used up by a partial reconciliation is
+        reconciled as well, so the flag of the remaining lines is read
+        again before the next method.
+        """
+        snapshot.discard(move_line_ids)
+        line_ids = snapshot.line_ids()
+        if not line_ids:
+            return
+        self.env.cr.execute(
+            "SELECT id FROM account_move_line "
+            "WHERE id IN %s AND reconciled",
+            (tuple(line_ids),)
+        )
+        snapshot.discard([row[0] for row in self.env.cr.fetchall()])
+
+    @api.multi
+    def _reset_watermark(self):
+        """ Force a full run when the configuration of the task changes """
+        self.filtered('watermark').write({'watermark': False})
+
+    @api.multi
+    def _get_changed_since(self):
+        """ Return the watermark from which an incremental run starts,
+        or False when a full run has to be done
+        """
+        self.ensure_one()
+        if not (self.incremental and self.watermark and
+                self.last_full_run):
+            return False
+        if self.full_run_interval:
+            next_full_run = (fields.Datetime.to_datetime(self.last_full_run) +
+                             timedelta(days=self.full_run_interval))
+            if next_full_run <= fields.Datetime.now():
+                return False
+        return self.watermark
+
+    @api.multi
+    def _get_run_start(self):
+        """ Return the watermark of the run starting
+
+        A line is dated by the start of the transaction writing it, so a
+        transaction running when the run starts can commit lines dated
+        before it, which the run does not see. The watermark is taken
+        before the oldest transaction running on the database, less the
+        overlap of the task, so the next incremental run reads them.
+        """
+        self.ensure_one()
+        self.env.cr.execute(
+            "SELECT LEAST(now(), min(xact_start)) AT TIME ZONE 'UTC' "
+            "FROM pg_stat_activity "
+            "WHERE datname = current_database()"
+        )
+        run_start = self.env.cr.fetchone()[0]
+        return run_start - timedelta(minutes=self.watermark_overlap)
+
+    @api.multi
+    def _update_watermark(self, run_start, changed_since):
+        self.ensure_one()
+        vals = {'watermark': run_start}
+        if not changed_since:
+            vals['last_full_run'] = run_start
+        self.write(vals)
+
+    @api.multi
+    def _compute_claimed_by(self):
+        self.env.cr.execute(
+            "SELECT lock.objid, activity.application_name, "
+            "       activity.client_addr, activity.pid "
+            "FROM pg_locks lock "
+            "JOIN pg_stat_activity activity ON activity.pid = lock.pid "
+            "WHERE lock.locktype = 'advisory' AND lock.granted "
+            "AND lock.classid = hashtext(%s)::oid AND lock.objsubid = 2 "
+            "AND lock.objid IN %s",
+            (self._claim_lock_key, tuple(self.ids) or (None,))
+        )
+        claims = dict(
+            (task_id, '%s@%s (pid %s)' % (application, client or 'local',
+                                          pid))
+            for task_id, application, client, pid in self.env.cr.fetchall()
+        )
         for rec in self:
-            ctx = self.env.context.copy()
-            ctx['commit_every'] = (
-                rec.account.company_id.reconciliation_commit_every
+            rec.claimed_by = claims.get(rec.id, False)
+
+    # namespaces of the advisory locks claiming the tasks and accounts
+    _claim_lock_key = 'account_mass_reconcile'
+    _claim_account_lock_key = 'account_mass_reconcile_account'
+
+    @api.multi
+    def _claim(self):
+        """ Claim the task for the current worker
+
+        The claim is a session advisory lock on the task and one on each
+        of its accounts, as two tasks reconciling the same account would
+        collide. Other workers skip the claimed tasks.
+
+        The locks are taken on a dedicated connection in autocommit, so
+        a failure of the run cannot prevent their release by `_release`,
+        and they go away with the connection if the worker dies.
+
+        :return: cursor of the connection holding the claim, None when
+                 the task or one of its accounts is claimed by another
+                 worker
+        """
+        self.ensure_one()
+        claim_cr = sql_db.db_connect(self.env.cr.dbname).cursor()
+        claim_cr.autocommit(True)
+        keys = [(self._claim_lock_key, self.id)]
+        keys += [(self._claim_account_lock_key, account_id)
+                 for account_id in self._get_accounts().ids]
+        for key in keys:
+            claim_cr.execute(
+                "SELECT pg_try_advisory_lock(hashtext(%s), %s)", key
             )
-            if ctx['commit_every']:
-                new_cr = sql_db.db_connect(self.env.cr.dbname).cursor()
-            else:
-                new_cr = self.env.cr
+            if not claim_cr.fetchone()[0]:
+                self._release(claim_cr)
+                return None
+        return claim_cr
 
-            try:
-                all_ml_rec_ids = []
+    @api.model
+    def _release(self, claim_cr):
+        """ Release a claim returned by `_claim` and close its cursor """
+        try:
+            # the connection is only used by the claim, it goes back to
+            # the pool without any lock
+            claim_cr.execute("SELECT pg_advisory_unlock_all()")
+        finally:
+            claim_cr.close()
 
-                for method in rec.reconcile_method:
-                    rec_model = self.env[method.name]
-                    auto_rec_id = rec_model.create(
-                        self._prepare_run_transient(method)
-                        )
+    @api.multi
+    def _run_reconcile_method(self, method, partner_ids=None,
+                              changed_since=False, stats=None,
+                              resume_from_id=0, account=None):
+        """ Run a reconciliation method, restricted on some partners
+        when ``partner_ids`` is given and on the keys of the lines
+        changed since ``changed_since`` when given
+
+        :param stats: `ReconcileStats` collecting the metrics of the run
+        :param resume_from_id: id of the credit line from which an
+                               interrupted run of the method is resumed
+        :param account: account reconciled, the account of the profile
+                        by default
+        :return: list of reconciled ids
+        """
+        self.ensure_one()
+        vals = self._prepare_run_transient(method, account=account)
+        if partner_ids:
+            vals['partner_ids'] = [(6, 0, partner_ids)]
+        if changed_since:
+            vals['changed_since'] = changed_since
+        if resume_from_id:
+            vals['resume_from_id'] = resume_from_id
+        rec_model = self.env[method.name]
+        if stats is not None:
+            rec_model = rec_model.with_context(mass_reconcile_stats=stats)
+        auto_rec_id = rec_model.create(vals)
+        ml_rec_ids = auto_rec_id.automatic_reconcile()
+        if stats is not None:
+            stats.reconciled_lines += len(ml_rec_ids)
+        return ml_rec_ids
+
+    @api.multi
+    def _get_partner_shards(self, count, account=None):
+        """ Split the partners of the unreconciled lines in ``count``
+        shards having about the same number of lines
+
+        :param account: account of the lines, the account of the profile
+                        by default
+        :return: list of lists of partner ids
+        """
+        self.ensure_one()
+        if account is None:
+            account = self.account
+        self.env.cr.execute(
+            "SELECT partner_id, COUNT(*) FROM account_move_line "
+            "WHERE account_id = %s AND NOT reconciled "
+            "AND partner_id IS NOT NULL "
+            "GROUP BY partner_id "
+            "ORDER BY COUNT(*) DESC, partner_id",
+            (account.id,)
+        )
+        shards = [[] for __ in range(count)]
+        # assign the biggest partners first to the least loaded shard
+        loads = [(0, index) for index in range(count)]
+        for partner_id, line_count in self.env.cr.fetchall():
+            load, index = heapq.heappop(loads)
+            shards[index].append(partner_id)
+            heapq.heappush(loads, (load + line_count, index))
+        return [shard for shard in shards if shard]
+
+    @api.multi
+    def _use_shard_processes(self):
+        """ Return True when the shards of a sharded run are matched by
+        forked processes
+
+        The processes are enabled by a setting of the companies of the
+        accounts, as they only see the committed lines: the run is then
+        committed after each shard. The worker is only forked on a
+        server running with workers, forking a threaded server is not
+        safe.
+        """
+        self.ensure_one()
+        if not (self.shard_workers > 1 and all(
+                self._get_accounts().mapped(
+                    'company_id.reconciliation_shard_processes'))):
+            return False
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return False
+        if not isinstance(odoo_server.server, odoo_server.PreforkServer):
+            _logger.warning("The shards of the reconcile task %s are "
+                            "matched by the worker, the server does not "
+                            "run with workers", self.name)
+            return False
+        return True
+
+    @api.multi
+    def _shard_process_pool(self):
+        """ Return the pool of processes matching the shards of a sharded
+        run, None when the shards are matched by the current worker, see
+        `_use_shard_processes`
+        """
+        self.ensure_one()
+        if not self._use_shard_processes():
+            return None
+        return multiprocessing.get_context('fork').Pool(
+            self.shard_workers, initializer=_init_shard_process,
+            initargs=(self.env.cr.dbname,)
+        )
+
+    @api.multi
+    def _match_shard(self, method, account, partner_ids, changed_since):
+        """ Match the lines of a shard in a simulated run, without
+        reconciling them
+
+        :return: tuple (proposals of the `ReconcileSimulation`,
+                        `ReconcileStats`)
+        """
+        self.ensure_one()
+        simulation = ReconcileSimulation()
+        stats = ReconcileStats()
+        self.with_context(
+            mass_reconcile_simulation=simulation
+        )._run_reconcile_method(
+            method, partner_ids=partner_ids, changed_since=changed_since,
+            stats=stats, account=account
+        )
+        return simulation.proposals, stats
+
+    @api.multi
+    def _reconcile_shard(self, method, account, proposals, stats):
+        """ Reconcile the groups proposed by the matching of a shard
+
+        :return: list of the ids of the fully reconciled lines
+        """
+        self.ensure_one()
+        vals = self._prepare_run_transient(method, account=account)
+        rec = self.env[method.name].with_context(
+            mass_reconcile_stats=stats
+        ).create(vals)
+        return rec._reconcile_proposals(proposals)
+
+    @api.multi
+    def _run_reconcile_sharded(self, history, method_stats,
+                               changed_since=False, commit=False):
+        """ Run the reconciliation methods by shards of partners
 
-                    ml_rec_ids = auto_rec_id.automatic_reconcile()
+        The methods which never match lines of different partners are
+        split in shards of partners, the other ones run on a single
+        shard. The lines of each shard are matched in a simulated run,
+        see `_match_shard`, by a pool of processes when
+        `_use_shard_processes` allows it, by the current worker
+        otherwise.
 
-                    all_ml_rec_ids += ml_rec_ids
+        The groups proposed for each shard are reconciled in the cursor
+        of the run, as the matching of the shards ends, so the write-off
+        and exchange entries of the shards do not compete for the
+        sequences of the journals. The reconciliations of each shard are
+        added to the history, and committed when ``commit`` is set.
 
-                reconcile_ids = find_reconcile_ids(
-                    'full_reconcile_id',
-                    all_ml_rec_ids
+        :param history: history of the run
+        :param list method_stats: list of tuples (method, `ReconcileStats`,
+                                  account) completed with the methods
+                                  which run
+        """
+        self.ensure_one()
+        cr = self.env.cr
+        context = dict(
+            (key, value) for key, value in self.env.context.items()
+            if not key.startswith('mass_reconcile_')
+        )
+        process_pool = self._shard_process_pool()
+        try:
+            for account in self._get_accounts():
+                for method in self.reconcile_method:
+                    if self.env[method.name]._shard_by_partner:
+                        shards = self._get_partner_shards(
+                            self.shard_workers, account=account
+                        )
+                    else:
+                        shards = [None]
+                    _logger.info("Run the method %s of the reconcile task "
+                                 "%s on the account %s on %d shards",
+                                 method.name, self.name, account.code,
+                                 len(shards))
+                    stats = ReconcileStats()
+                    method_stats.append((method, stats, account))
+                    if process_pool is not None:
+                        results = process_pool.imap_unordered(
+                            _match_shard,
+                            [(cr.dbname, self.env.uid, context, self.id,
+                              method.id, account.id, partner_ids,
+                              changed_since)
+                             for partner_ids in shards]
+                        )
+                    else:
+                        results = (
+                            self._match_shard(method, account, partner_ids,
+                                              changed_since)
+                            for partner_ids in shards
+                        )
+                    # the shards are reconciled as their matching ends
+                    for proposals, shard_stats in results:
+                        stats.merge(shard_stats)
+                        ml_rec_ids = self._reconcile_shard(
+                            method, account, proposals, stats
+                        )
+                        history._record_progress(ml_rec_ids)
+                        if commit:
+                            cr.commit()
+                            stats.commits += 1
+        finally:
+            if process_pool is not None:
+                process_pool.terminate()
+                process_pool.join()
+
+    @api.multi
+    def run_reconcile(self):
+        """ Run the reconcile tasks, each one being claimed during its run
+        so it does not collide with the scheduler
+
+        :raise UserError: when a task or one of its accounts is being
+                          reconciled by another worker
+        """
+        for rec in self:
+            claim_cr = rec._claim()
+            if claim_cr is None:
+                raise UserError(
+                    _('The reconcile task %s or one of its accounts is '
+                      'already being reconciled.') % rec.name
                 )
-                self.env['mass.reconcile.history'].create(
-                    {
-                        'mass_reconcile_id': rec.id,
-                        'date': fields.Datetime.now(),
-                        'reconcile_ids': [
-                            (4, rid) for rid in reconcile_ids
-                            ],
-                    })
-            except Exception as e:
-                # In case of error, we log it in the mail thread, log the
-                # stack trace and create an empty history line; otherwise,
-                # the cron will just loop on this reconcile task.
-                _logger.exception(
-                    "The reconcile task %s had an exception: %s",
-                    rec.name, str(e)
+            try:
+                rec._run_reconcile()
+            finally:
+                rec._release(claim_cr)
+        return True
+
+    @api.multi
+    def _run_reconcile(self):
+        """ Run the reconcile task, claimed by the caller
+
+        When the run commits, after the batches of groups or the shards,
+        a failure rolls back what was done since the last commit.
+        Otherwise, the run is done in a savepoint rolled back on failure.
+        In both cases, the failure is recorded on the history of the run.
+        """
+        self.ensure_one()
+        accounts = self._get_accounts()
+        commit_every = max(
+            accounts.mapped('company_id.reconciliation_commit_every') or
+            [0]
+        )
+        # the processes matching the shards only see the committed lines
+        commit = bool(commit_every) or self._use_shard_processes()
+        history = self.env['mass.reconcile.history']
+        method_stats = []
+        try:
+            # lines changed during the run will be reconciled
+            # by the next incremental run
+            run_start = self._get_run_start()
+            changed_since = self._get_changed_since()
+            # the history is written at each commit, and an
+            # interrupted run can be resumed from its checkpoint
+            history = self._resume_or_start_history()
+            if commit:
+                # the history is kept when the run fails
+                self.env.cr.commit()
+                ml_rec_ids = self._run_reconcile_steps(
+                    history, method_stats, changed_since=changed_since,
+                    commit=True
                 )
-                message = _("There was an error during reconciliation : %s") \
-                    % str(e)
-                rec.message_post(body=message)
-                self.env['mass.reconcile.history'].create(
-                    {
-                        'mass_reconcile_id': rec.id,
-                        'date': fields.Datetime.now(),
-                        'reconcile_ids': [],
-                    }
+            else:
+                with self.env.cr.savepoint():
+                    ml_rec_ids = self._run_reconcile_steps(
+                        history, method_stats, changed_since=changed_since
+                    )
+            self._create_history(ml_rec_ids, method_stats=method_stats,
+                                 history=history)
+            self._update_watermark(run_start, changed_since)
+        except Exception as e:
+            # In case of error, we log it in the mail thread, log the
+            # stack trace and mark the history of the run as failed;
+            # otherwise, the cron will just loop on this reconcile task.
+            _logger.exception(
+                "The reconcile task %s had an exception: %s",
+                self.name, str(e)
+            )
+            if commit:
+                self.env.cr.rollback()
+            self.env.clear()
+            message = _("There was an error during reconciliation : %s") \
+                % str(e)
+            self.message_post(body=message)
+            self._create_history([], method_stats=method_stats,
+                                 history=history.exists() or None,
+                                 failed=True)
+        finally:
+            self._invalidate_unreconciled_count()
+
+    @api.multi
+    def _run_reconcile_steps(self, history, method_stats,
+                             changed_since=False, commit=False):
+        """ Run the reconciliation methods of the task
+
+        :param history: history of the run, resumed from its checkpoint
+        :param list method_stats: list of tuples (method, `ReconcileStats`,
+                                  account) completed with the methods
+                                  which run
+        :param commit: True when the run commits, see `_run_reconcile`
+        :return: list of the ids of the reconciled lines
+        """
+        self.ensure_one()
+        if self.shard_workers > 1:
+            self._run_reconcile_sharded(history, method_stats,
+                                        changed_since=changed_since,
+                                        commit=commit)
+            return []
+        accounts = self._get_accounts()
+        all_ml_rec_ids = []
+        steps = self._get_run_steps()
+        checkpoint_method = history.checkpoint_method_id
+        checkpoint = (history.checkpoint_account_id or self.account,
+                      checkpoint_method)
+        if checkpoint in steps:
+            # the previous methods are done
+            steps = steps[steps.index(checkpoint):]
+            _logger.info("Resume the reconcile task %s from %s "
+                         "on the account %s", self.name,
+                         checkpoint_method.name, checkpoint[0].code)
+        task = self.with_context(mass_reconcile_history_id=history.id)
+
+        # the lines of all the accounts are loaded at once for
+        # all the methods, unless they have to be streamed
+        snapshots = {}
+        if (len(steps) > 1 and not changed_since and
+                not any(accounts.mapped(
+                    'company_id.reconciliation_fetch_chunk_size'))):
+            snapshot_stats = ReconcileStats()
+            with snapshot_stats.timer('query_time'):
+                snapshots = self._get_candidate_snapshots(
+                    self.env['account.account'].union(
+                        *[step[0] for step in steps])
                 )
-            finally:
-                if ctx['commit_every']:
-                    new_cr.commit()
-                    new_cr.close()
 
-        return True
+        for account, method in steps:
+            resume_from_id = 0
+            if (account, method) == checkpoint:
+                resume_from_id = history.checkpoint_position
+            history.write({
+                'checkpoint_account_id': account.id,
+                'checkpoint_method_id': method.id,
+                'checkpoint_position': resume_from_id,
+            })
+            stats = ReconcileStats()
+            if snapshots and not method_stats:
+                # the snapshots are loaded for the first method
+                stats.merge(snapshot_stats)
+            method_stats.append((method, stats, account))
+            snapshot = snapshots.get(account.id)
+            ml_rec_ids = task.with_context(
+                mass_reconcile_snapshot=snapshot
+            )._run_reconcile_method(
+                method, changed_since=changed_since, stats=stats,
+                resume_from_id=resume_from_id, account=account
+            )
+
+            all_ml_rec_ids += ml_rec_ids
+            if snapshot is not None:
+                self._discard_reconciled(snapshot, ml_rec_ids)
+        return all_ml_rec_ids
 
     def _no_history(self):
         """ Raise an `orm.except_orm` error, supposed to
@@ -295,7 +1122,7 @@ class AccountMassReconcile(models.Model):
         self.ensure_one()
         obj_move_line = self.env['account.move.line']
         lines = obj_move_line.search(
-            [('account_id', '=', self.account.id),
+            [('account_id', 'in', self._get_accounts().ids),
              ('reconciled', '=', False)])
         name = _('Unreconciled items')
         return self._open_move_line_list(lines.ids or [], name)
@@ -308,28 +1135,140 @@ class AccountMassReconcile(models.Model):
             self._no_history()
         return self.last_history.open_reconcile()
 
+    @api.multi
+    def simulate_reconcile(self):
+        """ Run the matching of all the methods without reconciling, and
+        open the reconciliations which would be done
+
+        Nothing is reconciled nor committed, so the configuration of a
+        profile can be tuned on a production account.
+        """
+        self.ensure_one()
+        simulation = ReconcileSimulation()
+        task = self.with_context(mass_reconcile_simulation=simulation)
+        accounts = self._get_accounts()
+        steps = self._get_run_steps()
+        snapshots = {}
+        if (len(steps) > 1 and
+                not any(accounts.mapped(
+                    'company_id.reconciliation_fetch_chunk_size'))):
+            snapshots = self._get_candidate_snapshots(accounts)
+        for account, method in steps:
+            snapshot = snapshots.get(account.id)
+            ml_rec_ids = task.with_context(
+                mass_reconcile_snapshot=snapshot
+            )._run_reconcile_method(method, account=account)
+            if snapshot is not None:
+                snapshot.discard(ml_rec_ids)
+        # the partners are read from the database, the pairs found by the
+        # database only have their amounts
+        partners = {}
+        if simulation.line_ids:
+            self.env.cr.execute(
+                "SELECT id, partner_id FROM account_move_line "
+                "WHERE id IN %s",
+                (tuple(simulation.line_ids),)
+            )
+            partners = dict(self.env.cr.fetchall())
+        line_vals = []
+        writeoff_total = 0.
+        for sequence, proposal in enumerate(simulation.proposals):
+            line_partners = set(partners.get(line_id)
+                                for line_id in proposal['line_ids'])
+            writeoff_amount = proposal['debit'] - proposal['credit']
+            if proposal['full']:
+                writeoff_total += abs(writeoff_amount)
+            line_vals.append((0, 0, {
+                'sequence': sequence,
+                'method': proposal['method'],
+                'account_id': proposal['account_id'],
+                'move_line_ids': [(6, 0, proposal['line_ids'])],
+                'partner_id': (line_partners.pop()
+                               if len(line_partners) == 1 else False),
+                'debit': proposal['debit'],
+                'credit': proposal['credit'],
+                'writeoff_amount': writeoff_amount,
+                'full': proposal['full'],
+                'writeoff_account_id': proposal['writeoff_account_id'],
+                'date': proposal['date'],
+            }))
+        result = self.env['mass.reconcile.simulation'].create({
+            'mass_reconcile_id': self.id,
+            'date': fields.Datetime.now(),
+            'proposal_count': len(simulation.proposals),
+            'move_line_count': len(simulation.line_ids),
+            'writeoff_amount': writeoff_total,
+            'line_ids': line_vals,
+        })
+        return {
+            'name': _('Simulation'),
+            'type': 'ir.actions.act_window',
+            'res_model': 'mass.reconcile.simulation',
+            'res_id': result.id,
+            'view_mode': 'form',
+            'view_type': 'form',
+            'target': 'current',
+        }
+
     @api.model
-    def run_scheduler(self, run_all=None):
-        """ Launch the reconcile with the oldest run
+    def run_scheduler(self, run_all=None, time_budget=None):
+        """ Launch the reconcile tasks by priority
         This function is mostly here to be used with cron task
 
         :param run_all: if set it will ingore lookup and launch
                     all reconciliation
+        :param time_budget: number of seconds after which no new task is
+                    started; without budget, only the task with the
+                    highest priority is launched. Each task is committed
+                    at its end.
         :returns: True in case of success or raises an exception
 
         """
-        def _get_date(reconcile):
-            if reconcile.last_history.date:
-                return fields.Datetime.to_datetime(reconcile.last_history.date)
-            else:
-                return datetime.min
-
         reconciles = self.search([])
         assert reconciles.ids, "No mass reconcile available"
-        if run_all:
-            reconciles.run_reconcile()
-            return True
-        reconciles.sorted(key=_get_date)
-        older = reconciles[0]
-        older.run_reconcile()
+        if not run_all:
+            now = fields.Datetime.now()
+            reconciles = reconciles.sorted(
+                key=lambda rec: rec._scheduler_priority(now), reverse=True
+            )
+        start = time.time()
+        for rec in reconciles:
+            if time_budget and time.time() - start >= time_budget:
+                break
+            # the task or its account is run by another worker
+            claim_cr = rec._claim()
+            if claim_cr is None:
+                continue
+            try:
+                rec._run_reconcile()
+                # a failure of a following task must not roll back the
+                # reconciliations of this one
+                self.env.cr.commit()
+            except Exception:
+                _logger.exception("The reconcile task %s failed", rec.name)
+                self.env.cr.rollback()
+                self.env.clear()
+            finally:
+                # released once the task is committed, so another worker
+                # never sees its lines as unreconciled
+                rec._release(claim_cr)
+            if not (run_all or time_budget):
+                break
         return True
+
+    @api.multi
+    def _scheduler_priority(self, now):
+        """ Priority of the task in the scheduler
+
+        Grows with the backlog of the account and with the time since
+        the last run, so idle tasks are run eventually even behind
+        busy accounts.
+        """
+        self.ensure_one()
+        if self.last_history.date:
+            last_run = fields.Datetime.to_datetime(self.last_history.date)
+        else:
+            last_run = fields.Datetime.to_datetime(self.create_date)
+        idle_hours = max((now - last_run).total_seconds() / 3600., 0.)
+        return (self.scheduler_weight *
+                (1 + self.unreconciled_count) * (1 + idle_hours))
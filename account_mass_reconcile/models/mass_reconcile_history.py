@@ -14,14 +14,6 @@ class MassReconcileHistory(models.Model):
     _rec_name = 'mass_reconcile_id'
     _order = 'date DESC'
 
-    @api.multi
-    @api.depends('reconcile_ids')
-    def _get_reconcile_line_ids(self):
-        for rec in self:
-            rec.reconcile_line_ids = rec.mapped(
-                'reconcile_ids.reconciled_line_ids'
-            ).ids
-
     mass_reconcile_id = fields.Many2one(
         'account.mass.reconcile',
         string='Reconcile Profile',
@@ -42,7 +34,17 @@ class MassReconcileHistory(models.Model):
         comodel_name='account.move.line',
         relation='account_move_line_history_rel',
         string='Reconciled Items',
-        compute='_get_reconcile_line_ids',
+        readonly=True,
+    )
+    reconcile_count = fields.Integer(
+        string='Full Reconciliations',
+        readonly=True,
+        default=0,
+    )
+    reconcile_line_count = fields.Integer(
+        string='Reconciled Items',
+        readonly=True,
+        default=0,
     )
     company_id = fields.Many2one(
         'res.company',
@@ -51,6 +53,103 @@ class MassReconcileHistory(models.Model):
         readonly=True,
         related='mass_reconcile_id.company_id',
     )
+    stat_ids = fields.One2many(
+        'mass.reconcile.history.stat',
+        'history_id',
+        string='Metrics',
+        readonly=True,
+    )
+    state = fields.Selection(
+        [('running', 'Running'),
+         ('done', 'Done'),
+         ('failed', 'Failed')],
+        string='State',
+        readonly=True,
+        default='done',
+        help="A run which failed or was interrupted while running is "
+             "resumed from its checkpoint by the next run of the profile "
+             "when the profile resumes the interrupted runs.",
+    )
+    checkpoint_account_id = fields.Many2one(
+        'account.account',
+        string='Checkpoint Account',
+        readonly=True,
+        ondelete='set null',
+    )
+    checkpoint_method_id = fields.Many2one(
+        'account.mass.reconcile.method',
+        string='Checkpoint Method',
+        readonly=True,
+        ondelete='set null',
+    )
+    checkpoint_position = fields.Integer(
+        string='Checkpoint Credit Line',
+        readonly=True,
+        help="Id of the credit line from which the checkpoint method "
+             "is resumed.",
+    )
+
+    @api.multi
+    def _add_reconciliations(self, reconcile_ids):
+        """ Link full reconciliations and their lines to the history
+
+        The relation rows are inserted in bulk rather than one by one
+        by the ORM, as a run can produce tens of thousands of
+        reconciliations. The reconciliations already linked are ignored.
+
+        :param list reconcile_ids: ids of `account.full.reconcile`
+        """
+        self.ensure_one()
+        if not reconcile_ids:
+            return
+        reconcile_field = self._fields['reconcile_ids']
+        line_field = self._fields['reconcile_line_ids']
+        cr = self.env.cr
+        cr.execute(
+            "INSERT INTO %s (%s, %s) SELECT %%s, unnest(%%s) "
+            "ON CONFLICT DO NOTHING"
+            % (reconcile_field.relation, reconcile_field.column1,
+               reconcile_field.column2),
+            (self.id, list(reconcile_ids))
+        )
+        reconcile_count = cr.rowcount
+        cr.execute(
+            "INSERT INTO %s (%s, %s) "
+            "SELECT %%s, id FROM account_move_line "
+            "WHERE full_reconcile_id = ANY(%%s) "
+            "ON CONFLICT DO NOTHING"
+            % (line_field.relation, line_field.column1, line_field.column2),
+            (self.id, list(reconcile_ids))
+        )
+        line_count = cr.rowcount
+        cr.execute(
+            "UPDATE mass_reconcile_history "
+            "SET reconcile_count = COALESCE(reconcile_count, 0) + %s, "
+            "    reconcile_line_count = "
+            "        COALESCE(reconcile_line_count, 0) + %s "
+            "WHERE id = %s",
+            (reconcile_count, line_count, self.id)
+        )
+        self.invalidate_cache(['reconcile_ids', 'reconcile_line_ids',
+                               'reconcile_count', 'reconcile_line_count'],
+                              self.ids)
+
+    @api.multi
+    def _record_progress(self, move_line_ids, resume_from_id=None):
+        """ Add the reconciliations of lines to the history of a running
+        task, and the position from which its method would be resumed
+
+        :param list move_line_ids: ids of reconciled move lines
+        :param int resume_from_id: id of the credit line from which the
+                                   current method is resumed
+        """
+        self.ensure_one()
+        self._add_reconciliations(
+            self.mass_reconcile_id._find_reconcile_ids('full_reconcile_id',
+                                                       move_line_ids)
+        )
+        if resume_from_id is not None:
+            self.checkpoint_position = resume_from_id
 
     @api.multi
     def _open_move_lines(self):
@@ -60,7 +159,7 @@ class MassReconcileHistory(models.Model):
         :param history_id: id of the history
         :return: action to open the move lines
         """
-        move_line_ids = self.mapped('reconcile_ids.reconciled_line_ids').ids
+        move_line_ids = self.mapped('reconcile_line_ids').ids
         name = _('Reconciliations')
         return {
             'name': name,
@@ -85,3 +184,83 @@ class MassReconcileHistory(models.Model):
         """
         self.ensure_one()
         return self._open_move_lines()
+
+
+class MassReconcileHistoryStat(models.Model):
+    """ Metrics of a reconciliation method during a run """
+    _name = 'mass.reconcile.history.stat'
+    _description = 'Metrics of a reconciliation method run'
+    _order = 'history_id, sequence'
+
+    def _selection_name(self):
+        return self.env['account.mass.reconcile.method']._selection_name()
+
+    history_id = fields.Many2one(
+        'mass.reconcile.history',
+        string='History',
+        required=True,
+        readonly=True,
+        ondelete='cascade',
+    )
+    sequence = fields.Integer(readonly=True)
+    method_id = fields.Many2one(
+        'account.mass.reconcile.method',
+        string='Method',
+        readonly=True,
+        ondelete='set null',
+    )
+    name = fields.Selection(
+        '_selection_name',
+        string='Type',
+        readonly=True,
+    )
+    account_id = fields.Many2one(
+        'account.account',
+        string='Account',
+        readonly=True,
+        ondelete='set null',
+    )
+    lines_fetched = fields.Integer(
+        string='Lines Fetched',
+        readonly=True,
+    )
+    comparisons = fields.Integer(
+        string='Comparisons',
+        readonly=True,
+        help="Number of pairs of lines compared",
+    )
+    groups = fields.Integer(
+        string='Groups Found',
+        readonly=True,
+    )
+    reconcile_calls = fields.Integer(
+        string='Reconcile Calls',
+        readonly=True,
+    )
+    commits = fields.Integer(
+        string='Commits',
+        readonly=True,
+    )
+    reconciled_lines = fields.Integer(
+        string='Reconciled Items',
+        readonly=True,
+    )
+    query_time = fields.Float(
+        string='Query Time (s)',
+        readonly=True,
+    )
+    matching_time = fields.Float(
+        string='Matching Time (s)',
+        readonly=True,
+    )
+    write_time = fields.Float(
+        string='Write Time (s)',
+        readonly=True,
+    )
+    company_id = fields.Many2one(
+        'res.company',
+        string='Company',
+        store=True,
+        readonly=True,
+        related='history_id.company_id',
+    )
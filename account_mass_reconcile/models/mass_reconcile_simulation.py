@@ -0,0 +1,103 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo import models, api, fields
+
+
+class MassReconcileSimulation(models.TransientModel):
+    """ Reconciliations proposed by a simulated run of a profile """
+    _name = 'mass.reconcile.simulation'
+    _description = 'Simulation of a mass reconcile run'
+    _rec_name = 'mass_reconcile_id'
+
+    mass_reconcile_id = fields.Many2one(
+        'account.mass.reconcile',
+        string='Reconcile Profile',
+        readonly=True,
+    )
+    date = fields.Datetime(
+        string='Simulation date',
+        readonly=True,
+    )
+    line_ids = fields.One2many(
+        'mass.reconcile.simulation.line',
+        'simulation_id',
+        string='Proposed Reconciliations',
+        readonly=True,
+    )
+    proposal_count = fields.Integer(
+        string='Proposed Reconciliations',
+        readonly=True,
+    )
+    move_line_count = fields.Integer(
+        string='Proposed Items',
+        readonly=True,
+    )
+    writeoff_amount = fields.Float(
+        string='Total Write-off',
+        readonly=True,
+        help="Sum of the absolute write-off amounts of the full "
+             "reconciliations.",
+    )
+
+
+class MassReconcileSimulationLine(models.TransientModel):
+    """ Group of move lines a method would reconcile """
+    _name = 'mass.reconcile.simulation.line'
+    _description = 'Reconciliation proposed by a simulation'
+    _order = 'simulation_id, sequence, id'
+
+    @api.model
+    def _selection_method(self):
+        return self.env['account.mass.reconcile.method']._selection_name()
+
+    simulation_id = fields.Many2one(
+        'mass.reconcile.simulation',
+        string='Simulation',
+        required=True,
+        ondelete='cascade',
+        readonly=True,
+    )
+    sequence = fields.Integer(readonly=True)
+    method = fields.Selection(
+        '_selection_method',
+        string='Method',
+        readonly=True,
+    )
+    account_id = fields.Many2one(
+        'account.account',
+        string='Account',
+        readonly=True,
+    )
+    move_line_ids = fields.Many2many(
+        'account.move.line',
+        string='Items',
+        readonly=True,
+    )
+    partner_id = fields.Many2one(
+        'res.partner',
+        string='Partner',
+        readonly=True,
+    )
+    debit = fields.Float(readonly=True)
+    credit = fields.Float(readonly=True)
+    writeoff_amount = fields.Float(
+        string='Write-off',
+        readonly=True,
+    )
+    full = fields.Boolean(
+        string='Full Reconciliation',
+        readonly=True,
+        help="Unchecked when the items would be partially reconciled.",
+    )
+    writeoff_account_id = fields.Many2one(
+        'account.account',
+        string='Write-off Account',
+        readonly=True,
+    )
+    date = fields.Date(
+        string='Reconciliation Date',
+        readonly=True,
+        help="Empty when the reconciliation is done at the date of the "
+             "run.",
+    )
@@ -13,6 +13,37 @@ class AccountConfigSettings(models.TransientModel):
         help="Leave zero to commit only at the end of the process.",
         readonly=False,
     )
+    reconciliation_fetch_chunk_size = fields.Integer(
+        related="company_id.reconciliation_fetch_chunk_size",
+        string="How many lines to load at once when performing automatic "
+               "reconciliation.",
+        help="Leave zero to load all the candidate lines at once.",
+        readonly=False,
+    )
+    reconciliation_shard_processes = fields.Boolean(
+        related="company_id.reconciliation_shard_processes",
+        string="Match the shards of the automatic reconciliation in "
+               "parallel processes.",
+        help="Match the shards of the tasks having parallel workers in "
+             "processes forked from the worker running the task. The "
+             "processes only see the committed lines, so the run is "
+             "committed after each shard. Only used on a server running "
+             "with workers.",
+        readonly=False,
+    )
+    reconciliation_columnar = fields.Boolean(
+        related="company_id.reconciliation_columnar",
+        string="Store the candidate lines in NumPy arrays when performing "
+               "automatic reconciliation.",
+        help="The candidate lines shared by the methods of a run are kept "
+             "in arrays between the methods, and the totals of the "
+             "batches of groups of the advanced methods are computed on "
+             "them. The methods still build one row per line to match "
+             "the lines, and the simple methods compute the totals of "
+             "their pairs one by one. Requires the numpy Python "
+             "library.",
+        readonly=False,
+    )
 
 
 class Company(models.Model):
@@ -22,3 +53,28 @@ class Company(models.Model):
         string="How often to commit when performing automatic reconciliation.",
         help="Leave zero to commit only at the end of the process.",
     )
+    reconciliation_fetch_chunk_size = fields.Integer(
+        string="How many lines to load at once when performing automatic "
+               "reconciliation.",
+        help="Leave zero to load all the candidate lines at once.",
+    )
+    reconciliation_shard_processes = fields.Boolean(
+        string="Match the shards of the automatic reconciliation in "
+               "parallel processes.",
+        help="Match the shards of the tasks having parallel workers in "
+             "processes forked from the worker running the task. The "
+             "processes only see the committed lines, so the run is "
+             "committed after each shard. Only used on a server running "
+             "with workers.",
+    )
+    reconciliation_columnar = fields.Boolean(
+        string="Store the candidate lines in NumPy arrays when performing "
+               "automatic reconciliation.",
+        help="The candidate lines shared by the methods of a run are kept "
+             "in arrays between the methods, and the totals of the "
+             "batches of groups of the advanced methods are computed on "
+             "them. The methods still build one row per line to match "
+             "the lines, and the simple methods compute the totals of "
+             "their pairs one by one. Requires the numpy Python "
+             "library.",
+    )
@@ -2,9 +2,26 @@
 # Copyright 2010 Sébastien Beau
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+from bisect import bisect_left, bisect_right
+from collections import deque
+from itertools import groupby
+from operator import itemgetter
+
 from odoo import models, api
 
 
+def _first_unreconciled(links, idx):
+    """ Follow the links from ``idx`` to an index linked to itself
+
+    The links are halved on the way, so skipping a series of reconciled
+    lines is done in amortized logarithmic time.
+    """
+    while links[idx] != idx:
+        links[idx] = links[links[idx]]
+        idx = links[idx]
+    return idx
+
+
 class MassReconcileSimple(models.AbstractModel):
     _name = 'mass.reconcile.simple'
     _inherit = 'mass.reconcile.base'
@@ -12,44 +29,180 @@ class MassReconcileSimple(models.AbstractModel):
     # has to be subclassed
     # field name used as key for matching the move lines
     _key_field = None
+    # the lines are paired on equal amounts, which can be done by the
+    # database when pair_in_database is set
+    _exact_amounts = True
+
+    def _incremental_key_field(self):
+        return self._key_field
 
     @api.multi
     def rec_auto_lines_simple(self, lines):
+        """ Pair the lines sharing the same key
+
+        :param lines: iterable of dict of move lines, sorted by key
+        :return: list of reconciled ids
+        """
         if self._key_field is None:
             raise ValueError("_key_field has to be defined")
-        count = 0
         res = []
-        while (count < len(lines)):
-            for i in range(count + 1, len(lines)):
-                if lines[count][self._key_field] != lines[i][self._key_field]:
-                    break
-                check = False
-                if lines[count]['credit'] > 0 and lines[i]['debit'] > 0:
-                    credit_line = lines[count]
-                    debit_line = lines[i]
-                    check = True
-                elif lines[i]['credit'] > 0 and lines[count]['debit'] > 0:
-                    credit_line = lines[i]
-                    debit_line = lines[count]
-                    check = True
-                if not check:
-                    continue
+        with self._defer_reconciliations() as rec, \
+                self._get_stats().timer('matching_time'):
+            for dummy, bucket in groupby(lines,
+                                         key=itemgetter(self._key_field)):
+                res += rec._rec_auto_bucket_simple(list(bucket))
+        return res
+
+    @staticmethod
+    def _line_side(line):
+        if line['credit'] > 0:
+            return 'credit'
+        elif line['debit'] > 0:
+            return 'debit'
+        return None
+
+    @api.multi
+    def _rec_auto_bucket_simple(self, lines):
+        """ Pair the debit and credit lines having the same key
+
+        Each line, in order, is reconciled with the first following line
+        of the opposite side having an amount within the write-off. The
+        following lines are kept in queues per side and amount, so only
+        the lines with a matching amount are tried.
+
+        :param list lines: list of dict of move lines with the same key
+        :return: list of reconciled ids
+        """
+        stats = self._get_stats()
+        precision = self.env['decimal.precision'].precision_get('Account')
+        # the write-off is checked on the rounded difference, widen the
+        # range of amounts so no candidate is missed, the candidates are
+        # checked by `_reconcile_lines`
+        tolerance = self.write_off + 2 * 10 ** -precision
+        queues = {'debit': {}, 'credit': {}}
+        sides = []
+        for position, line in enumerate(lines):
+            side = self._line_side(line)
+            sides.append(side)
+            if side:
+                queues[side].setdefault(line[side], deque()).append(position)
+        amounts = dict((side, sorted(queues[side])) for side in queues)
+        consumed = set()
+        res = []
+        for position, line in enumerate(lines):
+            side = sides[position]
+            if side is None or position in consumed:
+                continue
+            opposite_side = 'debit' if side == 'credit' else 'credit'
+            opposite_amounts = amounts[opposite_side]
+            candidates = []
+            for idx in range(
+                    bisect_left(opposite_amounts, line[side] - tolerance),
+                    bisect_right(opposite_amounts, line[side] + tolerance)):
+                queue = queues[opposite_side][opposite_amounts[idx]]
+                # only the following lines can be paired, drop the
+                # lines already inspected or reconciled
+                while queue and (queue[0] <= position or
+                                 queue[0] in consumed):
+                    queue.popleft()
+                if queue:
+                    candidates.append(queue[0])
+            for candidate in sorted(candidates):
+                if side == 'credit':
+                    credit_line, debit_line = line, lines[candidate]
+                else:
+                    credit_line, debit_line = lines[candidate], line
+                stats.comparisons += 1
                 reconciled, dummy = self._reconcile_lines(
                     [credit_line, debit_line],
                     allow_partial=False
                     )
                 if reconciled:
+                    stats.groups += 1
                     res += [credit_line['id'], debit_line['id']]
-                    del lines[i]
+                    consumed.add(candidate)
                     break
-            count += 1
         return res
 
     def _simple_order(self, *args, **kwargs):
         return "ORDER BY account_move_line.%s" % self._key_field
 
+    @api.multi
+    def rec_auto_pairs_simple(self, pairs):
+        """ Reconcile the pairs of lines found by the database
+
+        :param pairs: iterable of tuples (credit line id, credit amount,
+                      credit line date, debit line id, debit amount,
+                      debit line date)
+        :return: list of reconciled ids
+        """
+        stats = self._get_stats()
+        res = []
+        with self._defer_reconciliations() as rec:
+            for (credit_id, credit, credit_date,
+                 debit_id, debit, debit_date) in pairs:
+                stats.comparisons += 1
+                credit_line = {'id': credit_id, 'debit': 0.,
+                               'credit': credit, 'date': credit_date}
+                debit_line = {'id': debit_id, 'debit': debit, 'credit': 0.,
+                              'date': debit_date}
+                reconciled, dummy = rec._reconcile_lines(
+                    [credit_line, debit_line],
+                    allow_partial=False
+                    )
+                if reconciled:
+                    stats.groups += 1
+                    res += [credit_id, debit_id]
+        return res
+
+    def _pairs_query(self):
+        """ Query returning the pairs of debit and credit lines having
+        the same key and the same amount
+
+        The lines of each key and amount are numbered by id, the n-th
+        credit line is paired with the n-th debit line.
+        """
+        key = "account_move_line.%s" % self._key_field
+        where, params = self._where_query()
+        where += " AND %s IS NOT NULL " % key
+        where2, params2 = self._get_filter()
+        candidates = ' '.join((
+            "SELECT account_move_line.id, account_move_line.debit, "
+            "account_move_line.credit, account_move_line.date, "
+            "%s AS key, " % key,
+            "ROW_NUMBER() OVER (PARTITION BY %s, " % key,
+            "account_move_line.debit, account_move_line.credit "
+            "ORDER BY account_move_line.id) AS row_rank",
+            self._from_query(),
+            where, where2))
+        query = ("WITH candidates AS (%s) "
+                 "SELECT c.id, c.credit, c.date, d.id, d.debit, d.date "
+                 "FROM candidates c "
+                 "JOIN candidates d "
+                 "ON d.key = c.key AND d.debit = c.credit "
+                 "AND d.row_rank = c.row_rank "
+                 "WHERE c.credit > 0 AND d.debit > 0 "
+                 "ORDER BY c.key, c.row_rank, c.id" % candidates)
+        return query, params + params2
+
     def _action_rec(self):
         """Match only 2 move lines, do not allow partial reconcile"""
+        stats = self._get_stats()
+        if self.pair_in_database and self._exact_amounts:
+            query, params = self._pairs_query()
+            with stats.timer('query_time'):
+                self.env.cr.execute(query, params)
+                pairs = self.env.cr.fetchall()
+            stats.lines_fetched += 2 * len(pairs)
+            return self.rec_auto_pairs_simple(pairs)
+        snapshot = self._get_snapshot()
+        if snapshot is not None:
+            lines = sorted(
+                (l for l in snapshot.lines if l[self._key_field] is not None),
+                key=itemgetter(self._key_field)
+            )
+            stats.lines_fetched += len(lines)
+            return self.rec_auto_lines_simple(lines)
         select = self._select_query()
         select += ", account_move_line.%s " % self._key_field
         where, params = self._where_query()
@@ -62,8 +215,7 @@ class MassReconcileSimple(models.AbstractModel):
             where, where2,
             self._simple_order()))
 
-        self.env.cr.execute(query, params + params2)
-        lines = self.env.cr.dictfetchall()
+        lines = self._fetch_lines(query, params + params2)
         return self.rec_auto_lines_simple(lines)
 
 
@@ -83,6 +235,7 @@ class MassReconcileSimplePartner(models.TransientModel):
     # has to be subclassed
     # field name used as key for matching the move lines
     _key_field = 'partner_id'
+    _shard_by_partner = True
 
 
 class MassReconcileSimpleReference(models.TransientModel):
@@ -92,3 +245,80 @@ class MassReconcileSimpleReference(models.TransientModel):
     # has to be subclassed
     # field name used as key for matching the move lines
     _key_field = 'ref'
+
+
+class MassReconcileSimplePartnerClosest(models.TransientModel):
+    _name = 'mass.reconcile.simple.partner.closest'
+    _inherit = 'mass.reconcile.simple'
+
+    # field name used as key for matching the move lines
+    _key_field = 'partner_id'
+    _shard_by_partner = True
+    _exact_amounts = False
+
+    @api.multi
+    def _rec_auto_bucket_simple(self, lines):
+        """ Pair each credit line with the debit line of the partner
+        having the closest amount, within the write-off
+
+        The debit amounts are kept sorted, so the closest one is found
+        by bisection. When a smaller and a larger amount are as close,
+        the larger one is used. Among the debit lines of the same amount,
+        the first one is used. The reconciled debit lines stay in the
+        sorted list, linked to the next and previous lines which are not
+        reconciled yet, instead of being removed from it.
+
+        :param list lines: list of dict of move lines with the same key
+        :return: list of reconciled ids
+        """
+        stats = self._get_stats()
+        precision = self.env['decimal.precision'].precision_get('Account')
+        factor = 10 ** precision
+        tolerance = int(round(self.write_off * factor))
+        # (amount, position) of the debit lines
+        debits = sorted(
+            (int(round(line['debit'] * factor)), position)
+            for position, line in enumerate(lines) if line['debit'] > 0
+        )
+        count = len(debits)
+        # following[i] leads to the first debit line not reconciled from
+        # the index i, preceding[i + 1] to the last one up to the index i,
+        # count and 0 when there is none
+        following = list(range(count + 1))
+        preceding = list(range(count + 1))
+        remaining = count
+        res = []
+        for credit_line in lines:
+            if not (credit_line['credit'] > 0 and remaining):
+                continue
+            amount = int(round(credit_line['credit'] * factor))
+            idx = bisect_left(debits, (amount, -1))
+            closest = _first_unreconciled(following, idx)
+            if closest == count:
+                closest = None
+            smaller = _first_unreconciled(preceding, idx) - 1
+            if smaller >= 0:
+                # the first line having the closest smaller amount
+                lower = _first_unreconciled(
+                    following, bisect_left(debits, (debits[smaller][0], -1))
+                )
+                # the larger amount wins when both are as close
+                if (closest is None or
+                        amount - debits[lower][0] <
+                        debits[closest][0] - amount):
+                    closest = lower
+            if abs(debits[closest][0] - amount) > tolerance:
+                continue
+            debit_line = lines[debits[closest][1]]
+            stats.comparisons += 1
+            reconciled, dummy = self._reconcile_lines(
+                [credit_line, debit_line],
+                allow_partial=False
+            )
+            if reconciled:
+                stats.groups += 1
+                res += [credit_line['id'], debit_line['id']]
+                following[closest] = closest + 1
+                preceding[closest + 1] = closest
+                remaining -= 1
+        return res
@@ -0,0 +1,213 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import logging
+from bisect import bisect_left
+from itertools import groupby
+from operator import itemgetter
+
+from odoo import models, api
+
+_logger = logging.getLogger(__name__)
+
+
+class MassReconcileSubsetPartner(models.TransientModel):
+    """ Reconcile a credit line with several debit lines of the same
+    partner whose amounts sum to the credit amount (with the write-off)
+
+    The debit lines combination is searched per credit line, in integer
+    amounts of the smallest currency unit, with an exhaustive
+    meet-in-the-middle search when the partner has few candidate debits
+    and a bounded depth-first search otherwise.
+    """
+    _name = 'mass.reconcile.subset.partner'
+    _inherit = 'mass.reconcile.base'
+
+    _shard_by_partner = True
+
+    # number of candidate debits up to which all the combinations are
+    # searched (meet-in-the-middle, 2 * 2 ** (n / 2) sums)
+    _subset_exhaustive_limit = 20
+    # maximum number of combinations tried for a credit line by the
+    # depth-first search
+    _subset_max_iterations = 100000
+
+    def _incremental_key_field(self):
+        return 'partner_id'
+
+    @staticmethod
+    def _subset_meet_in_middle(amounts, low, high):
+        """ Search a combination of amounts with a sum between low and
+        high by enumerating the sums of each half of the amounts
+
+        :param list amounts: positive integer amounts
+        :return: tuple of indexes of the amounts, or None
+        """
+        def sums(offset, half):
+            result = [(0, ())]
+            for idx, amount in enumerate(half, start=offset):
+                result += [(total + amount, chosen + (idx,))
+                           for total, chosen in result]
+            return result
+
+        middle = len(amounts) // 2
+        right = sorted(sums(middle, amounts[middle:]))
+        right_totals = [total for total, dummy in right]
+        for total, chosen in sums(0, amounts[:middle]):
+            idx = bisect_left(right_totals, low - total)
+            if idx < len(right) and right_totals[idx] <= high - total:
+                # the amounts are positive and low as well, the
+                # combination cannot be empty
+                return chosen + right[idx][1]
+        return None
+
+    @staticmethod
+    def _subset_depth_first(amounts, low, high, max_iterations):
+        """ Search a combination of amounts with a sum between low and
+        high, trying the biggest amounts first
+
+        A branch is pruned when its sum exceeds high, or when the sum of
+        all the remaining amounts cannot reach low.
+
+        :param list amounts: positive integer amounts, sorted descending
+        :return: tuple (tuple of indexes of the amounts or None,
+                        number of iterations)
+        """
+        count = len(amounts)
+        suffix = [0] * (count + 1)
+        for idx in range(count - 1, -1, -1):
+            suffix[idx] = suffix[idx + 1] + amounts[idx]
+        iterations = 0
+        stack = [(0, 0, ())]
+        while stack:
+            start, total, chosen = stack.pop()
+            children = []
+            for idx in range(start, count):
+                if total + suffix[idx] < low:
+                    # the following amounts are smaller
+                    break
+                if idx > start and amounts[idx] == amounts[idx - 1]:
+                    # same combinations as with the previous amount
+                    continue
+                iterations += 1
+                if iterations > max_iterations:
+                    return None, iterations
+                new_total = total + amounts[idx]
+                if new_total > high:
+                    continue
+                if new_total >= low:
+                    return chosen + (idx,), iterations
+                children.append((idx + 1, new_total, chosen + (idx,)))
+            # the biggest amounts are explored first
+            stack += reversed(children)
+        return None, iterations
+
+    @api.multi
+    def _find_subset(self, target, tolerance, amounts):
+        """ Search a combination of amounts summing to target
+
+        :param int target: amount to reach
+        :param int tolerance: accepted difference with the target
+        :param list amounts: positive integer amounts, sorted descending
+        :return: tuple of indexes of the amounts, or None
+        """
+        low, high = target - tolerance, target + tolerance
+        if low <= 0:
+            return None
+        if len(amounts) <= self._subset_exhaustive_limit:
+            self._get_stats().comparisons += 2 ** (len(amounts) // 2 + 1)
+            return self._subset_meet_in_middle(amounts, low, high)
+        subset, iterations = self._subset_depth_first(
+            amounts, low, high, self._subset_max_iterations
+        )
+        self._get_stats().comparisons += iterations
+        return subset
+
+    @api.multi
+    def _match_partner_lines(self, lines):
+        """ Find the combinations of debit lines paying each credit line
+        of a partner
+
+        :param list lines: list of dict of move lines of one partner
+        :return: list of groups of lines, a credit line and its debits
+        """
+        precision = self.env['decimal.precision'].precision_get('Account')
+        factor = 10 ** precision
+        tolerance = int(round(self.write_off * factor))
+        debits = sorted(
+            ((int(round(line['debit'] * factor)), line)
+             for line in lines if line['debit'] > 0),
+            key=itemgetter(0), reverse=True
+        )
+        groups = []
+        for credit_line in lines:
+            if not (credit_line['credit'] > 0 and debits):
+                continue
+            target = int(round(credit_line['credit'] * factor))
+            # the debits bigger than the credit can't be part of the sum
+            start = 0
+            while start < len(debits) and debits[start][0] > \
+                    target + tolerance:
+                start += 1
+            candidates = debits[start:]
+            subset = self._find_subset(
+                target, tolerance, [amount for amount, dummy in candidates]
+            )
+            if not subset:
+                continue
+            groups.append([credit_line] +
+                          [candidates[idx][1] for idx in subset])
+            used = set(start + idx for idx in subset)
+            debits = [debit for idx, debit in enumerate(debits)
+                      if idx not in used]
+        return groups
+
+    def _query_lines(self):
+        """ Return the candidate lines sorted by partner """
+        snapshot = self._get_snapshot()
+        if snapshot is not None:
+            lines = sorted(
+                (l for l in snapshot.lines if l['partner_id'] is not None),
+                key=itemgetter('partner_id', 'id')
+            )
+            self._get_stats().lines_fetched += len(lines)
+            return lines
+        select = self._select_query()
+        where, params = self._where_query()
+        where += " AND account_move_line.partner_id IS NOT NULL "
+        where2, params2 = self._get_filter()
+        query = ' '.join((
+            select,
+            self._from_query(),
+            where, where2,
+            "ORDER BY account_move_line.partner_id, account_move_line.id"))
+        return self._fetch_lines(query, params + params2)
+
+    def _action_rec(self):
+        """ Match a credit line with several debit lines, do not allow
+        partial reconcile
+        """
+        stats = self._get_stats()
+        commit_every = self._get_commit_every()
+        groups = []
+        with stats.timer('matching_time'):
+            for dummy, partner_lines in groupby(
+                    self._query_lines(), key=itemgetter('partner_id')):
+                groups += self._match_partner_lines(list(partner_lines))
+        stats.groups += len(groups)
+        _logger.info("Found %d combinations to reconcile", len(groups))
+        reconciled_ids = []
+        batch_size = commit_every or len(groups)
+        for start in range(0, len(groups), batch_size):
+            batch = groups[start:start + batch_size]
+            results = self._reconcile_groups(batch)
+            batch_ids = []
+            for lines, (reconciled, dummy) in zip(batch, results):
+                if reconciled:
+                    batch_ids += [line['id'] for line in lines]
+            reconciled_ids += batch_ids
+            if commit_every and len(batch) == commit_every:
+                self._checkpoint(batch_ids)
+                self.env.cr.commit()
+                stats.commits += 1
+        return reconciled_ids
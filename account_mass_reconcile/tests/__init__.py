@@ -5,3 +5,7 @@ from . import test_onchange_company
 from . import test_reconcile_history
 from . import test_reconcile
 from . import test_scenario_reconcile
+from . import test_advanced_reconcile
+from . import test_simple_reconcile
+from . import test_benchmark
+from . import test_subset_reconcile
@@ -0,0 +1,201 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from datetime import date, timedelta
+import random
+
+
+class SyntheticLedger(object):
+    """ Generate a receivable account with unreconciled journal items
+
+    Half of the lines are debits (invoices), the other half credits
+    (payments). A share of the payments, given by ``match_rate``, copies
+    the partner, reference, label and amount of an invoice, so every
+    reconciliation method can match them. The other payments get random
+    values.
+
+    The moves are inserted with SQL, only the account, journal and
+    partners are created with the ORM.
+
+    :param env: odoo environment
+    :param int size: number of unreconciled lines on the account
+    :param int partner_count: number of distinct partners
+    :param int ref_count: number of distinct invoice references,
+                          zero for a reference per invoice
+    :param float match_rate: share of payments matching an invoice
+    :param int seed: seed of the random generator
+    """
+
+    chunk_size = 10000
+
+    def __init__(self, env, size, partner_count=1000, ref_count=0,
+                 match_rate=0.8, seed=42):
+        self.env = env
+        self.size = size
+        self.partner_count = partner_count
+        self.ref_count = ref_count
+        self.match_rate = match_rate
+        self.random = random.Random(seed)
+        self.company = env.user.company_id
+        self.account = None
+        self.counterpart_account = None
+        self.journal = None
+        self.partner_ids = []
+
+    def _create_accounts(self):
+        account_obj = self.env['account.account']
+        code = 'BENCH%d' % self.size
+        self.account = account_obj.create({
+            'code': code,
+            'name': 'Benchmark receivable %d' % self.size,
+            'user_type_id': self.env.ref(
+                'account.data_account_type_receivable').id,
+            'reconcile': True,
+            'company_id': self.company.id,
+        })
+        self.counterpart_account = account_obj.create({
+            'code': '%sI' % code,
+            'name': 'Benchmark income %d' % self.size,
+            'user_type_id': self.env.ref(
+                'account.data_account_type_revenue').id,
+            'company_id': self.company.id,
+        })
+        self.journal = self.env['account.journal'].create({
+            'name': 'Benchmark %d' % self.size,
+            'code': 'BE%d' % len(str(self.size)),
+            'type': 'general',
+            'company_id': self.company.id,
+        })
+
+    def _create_partners(self):
+        partner_obj = self.env['res.partner']
+        self.partner_ids = [
+            partner_obj.create({'name': 'Benchmark partner %d' % idx}).id
+            for idx in range(self.partner_count)
+        ]
+
+    def _invoice_values(self, idx):
+        if self.ref_count:
+            ref = 'INV-%d' % self.random.randrange(self.ref_count)
+        else:
+            ref = 'INV-%d' % idx
+        return {
+            'partner_id': self.random.choice(self.partner_ids),
+            'ref': ref,
+            'name': 'INV/%d' % idx,
+            'amount': round(self.random.uniform(1, 10000), 2),
+            'date': date(2019, 1, 1) + timedelta(
+                days=self.random.randrange(365)),
+        }
+
+    def _payment_values(self, idx, invoice_values):
+        if invoice_values and self.random.random() < self.match_rate:
+            values = dict(invoice_values)
+            values['date'] += timedelta(days=self.random.randrange(60))
+            return values
+        return {
+            'partner_id': self.random.choice(self.partner_ids),
+            'ref': 'PAY-%d' % idx,
+            'name': 'PAY/%d' % idx,
+            'amount': round(self.random.uniform(1, 10000), 2),
+            'date': date(2019, 1, 1) + timedelta(
+                days=self.random.randrange(365)),
+        }
+
+    def _generate_values(self):
+        """ Yield the values of the receivable lines with a key
+        'is_debit' telling if the line is a debit or a credit
+        """
+        debit_count = self.size // 2
+        invoices = []
+        for idx in range(debit_count):
+            values = self._invoice_values(idx)
+            values['is_debit'] = True
+            invoices.append(values)
+            yield values
+        self.random.shuffle(invoices)
+        for idx in range(self.size - debit_count):
+            invoice_values = invoices[idx] if idx < len(invoices) else None
+            values = self._payment_values(idx, invoice_values)
+            values['is_debit'] = False
+            yield values
+
+    def _insert_chunk(self, chunk):
+        cr = self.env.cr
+        cr.execute(
+            "INSERT INTO account_move "
+            "(name, ref, date, journal_id, company_id, currency_id, state, "
+            " amount, create_uid, write_uid, create_date, write_date) "
+            "SELECT 'BENCH/' || t.name, t.ref, t.date, %s, %s, %s, "
+            "       'posted', t.amount, %s, %s, "
+            "       now() AT TIME ZONE 'UTC', now() AT TIME ZONE 'UTC' "
+            "FROM unnest(%s::varchar[], %s::varchar[], %s::date[], "
+            "            %s::numeric[]) "
+            "WITH ORDINALITY AS t(name, ref, date, amount, ordinality) "
+            "ORDER BY t.ordinality "
+            "RETURNING id",
+            (self.journal.id, self.company.id, self.company.currency_id.id,
+             self.env.uid, self.env.uid,
+             [values['name'] for values in chunk],
+             [values['ref'] for values in chunk],
+             [values['date'] for values in chunk],
+             [values['amount'] for values in chunk])
+        )
+        move_ids = sorted(row[0] for row in cr.fetchall())
+        lines = []
+        for move_id, values in zip(move_ids, chunk):
+            amount = values['amount']
+            sign = 1 if values['is_debit'] else -1
+            # the receivable line and its counterpart
+            lines.append((move_id, self.account.id, values['partner_id'],
+                          values['name'], values['ref'], values['date'],
+                          sign * amount, self.account.user_type_id.id))
+            lines.append((move_id, self.counterpart_account.id,
+                          values['partner_id'], values['name'],
+                          values['ref'], values['date'], -sign * amount,
+                          self.counterpart_account.user_type_id.id))
+        cr.execute(
+            "INSERT INTO account_move_line "
+            "(move_id, account_id, partner_id, name, ref, date, "
+            " date_maturity, debit, credit, balance, debit_cash_basis, "
+            " credit_cash_basis, balance_cash_basis, amount_currency, "
+            " amount_residual, amount_residual_currency, "
+            " company_currency_id, journal_id, company_id, user_type_id, "
+            " reconciled, blocked, tax_exigible, "
+            " create_uid, write_uid, create_date, write_date) "
+            "SELECT t.move_id, t.account_id, t.partner_id, t.name, t.ref, "
+            "       t.date, t.date, "
+            "       GREATEST(t.balance, 0), GREATEST(-t.balance, 0), "
+            "       t.balance, GREATEST(t.balance, 0), "
+            "       GREATEST(-t.balance, 0), t.balance, 0, "
+            "       CASE WHEN t.account_id = %s THEN t.balance ELSE 0 END, "
+            "       0, %s, %s, %s, t.user_type_id, false, false, true, "
+            "       %s, %s, "
+            "       now() AT TIME ZONE 'UTC', now() AT TIME ZONE 'UTC' "
+            "FROM unnest(%s::int[], %s::int[], %s::int[], %s::varchar[], "
+            "            %s::varchar[], %s::date[], %s::numeric[], "
+            "            %s::int[]) "
+            "AS t(move_id, account_id, partner_id, name, ref, date, "
+            "     balance, user_type_id)",
+            [self.account.id, self.company.currency_id.id, self.journal.id,
+             self.company.id, self.env.uid, self.env.uid] +
+            [list(column) for column in zip(*lines)]
+        )
+
+    def generate(self):
+        """ Create the account and its unreconciled lines
+
+        :return: the receivable account
+        """
+        self._create_accounts()
+        self._create_partners()
+        chunk = []
+        for values in self._generate_values():
+            chunk.append(values)
+            if len(chunk) == self.chunk_size:
+                self._insert_chunk(chunk)
+                chunk = []
+        if chunk:
+            self._insert_chunk(chunk)
+        self.env['account.move.line'].invalidate_cache()
+        return self.account
@@ -0,0 +1,68 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from odoo.tests import common
+
+
+class TestAdvancedReconcile(common.SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestAdvancedReconcile, cls).setUpClass()
+        cls.rec_model = cls.env['mass.reconcile.advanced.ref']
+        cls.debit_lines = [
+            {'id': 1, 'partner_id': 10, 'ref': 'INV/001', 'name': '/',
+             'debit': 100., 'credit': 0.},
+            {'id': 2, 'partner_id': 10, 'ref': False, 'name': 'inv/002 ',
+             'debit': 50., 'credit': 0.},
+            {'id': 3, 'partner_id': 11, 'ref': 'INV/001', 'name': '/',
+             'debit': 100., 'credit': 0.},
+            {'id': 4, 'partner_id': 10, 'ref': 'INV/003', 'name': 'INV/001',
+             'debit': 30., 'credit': 0.},
+        ]
+
+    def _credit_line(self, partner_id, ref):
+        return {'id': 100, 'partner_id': partner_id, 'ref': ref,
+                'name': '/', 'debit': 0., 'credit': 100.}
+
+    def test_index_matchers(self):
+        index = self.rec_model._build_opposite_index(self.debit_lines)
+        self.assertEqual({'partner_id', 'ref'}, set(index))
+        self.assertEqual({0, 1, 3}, index['partner_id'][10])
+        self.assertEqual({0, 2, 3}, index['ref']['inv/001'])
+
+    def test_search_opposites_with_index(self):
+        index = self.rec_model._build_opposite_index(self.debit_lines)
+        for partner_id, ref in ((10, 'INV/001'), (10, ' inv/002'),
+                                (11, 'INV/001'), (12, 'INV/001'),
+                                (10, 'INV/004')):
+            credit_line = self._credit_line(partner_id, ref)
+            self.assertEqual(
+                self.rec_model._search_opposites(credit_line,
+                                                 self.debit_lines),
+                self.rec_model._search_opposites(credit_line,
+                                                 self.debit_lines,
+                                                 index=index),
+            )
+        credit_line = self._credit_line(10, 'INV/001')
+        opposites = self.rec_model._search_opposites(
+            credit_line, self.debit_lines, index=index)
+        self.assertEqual([1, 4], [l['id'] for l in opposites])
+
+    def test_prepared_matchers(self):
+        debit_matchers = self.rec_model._prepare_opposite_matchers(
+            self.debit_lines)
+        self.assertEqual((('partner_id', (10,)), ('ref', ('', 'inv/002'))),
+                         debit_matchers[1])
+        index = self.rec_model._build_opposite_index(
+            self.debit_lines, opposite_matchers=debit_matchers)
+        for partner_id, ref in ((10, 'INV/001'), (10, ' inv/002'),
+                                (11, 'INV/001'), (10, 'INV/004')):
+            credit_line = self._credit_line(partner_id, ref)
+            self.assertEqual(
+                self.rec_model._search_opposites(credit_line,
+                                                 self.debit_lines),
+                self.rec_model._search_opposites(
+                    credit_line, self.debit_lines, index=index,
+                    opposite_matchers=debit_matchers),
+            )
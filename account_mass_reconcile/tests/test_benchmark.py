@@ -0,0 +1,138 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import json
+import logging
+import os
+import time
+
+from odoo.tests import common, tagged
+from .synthetic_ledger import SyntheticLedger
+
+_logger = logging.getLogger(__name__)
+
+
+def _env_list(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return [int(size) for size in value.split(',')]
+
+
+@tagged('-standard', 'mass_reconcile_benchmark')
+class TestBenchmarkReconcile(common.TransactionCase):
+    """ Time the reconciliation methods on synthetic ledgers
+
+    Not part of the standard tests, run it with
+    ``--test-tags mass_reconcile_benchmark``. The environment variables
+    below configure the ledgers:
+
+    * MASS_RECONCILE_BENCHMARK_SIZES: comma separated numbers of lines
+      (default: 10000,100000,1000000)
+    * MASS_RECONCILE_BENCHMARK_PARTNERS: number of partners (default 1000)
+    * MASS_RECONCILE_BENCHMARK_REFS: number of distinct invoice references,
+      0 for a reference per invoice (default 0)
+    * MASS_RECONCILE_BENCHMARK_MATCH_RATE: share of the payments matching
+      an invoice (default 0.8)
+    * MASS_RECONCILE_BENCHMARK_REPORT: path of the JSON report
+      (default: mass_reconcile_benchmark.json)
+
+    Every method runs on the same ledger: the reconciliations are rolled
+    back after each run.
+    """
+
+    def setUp(self):
+        super(TestBenchmarkReconcile, self).setUp()
+        self.sizes = _env_list('MASS_RECONCILE_BENCHMARK_SIZES',
+                               [10000, 100000, 1000000])
+        self.partner_count = int(
+            os.environ.get('MASS_RECONCILE_BENCHMARK_PARTNERS', 1000))
+        self.ref_count = int(
+            os.environ.get('MASS_RECONCILE_BENCHMARK_REFS', 0))
+        self.match_rate = float(
+            os.environ.get('MASS_RECONCILE_BENCHMARK_MATCH_RATE', 0.8))
+        self.report_path = os.environ.get(
+            'MASS_RECONCILE_BENCHMARK_REPORT',
+            'mass_reconcile_benchmark.json')
+        # a commit would end the transaction rolled back between the runs
+        self.env.user.company_id.reconciliation_commit_every = 0
+
+    def _rollback_to(self, savepoint):
+        self.env.cr.execute('ROLLBACK TO SAVEPOINT %s' % savepoint)
+        self.env.clear()
+
+    def _run_method(self, account, method):
+        task = self.env['account.mass.reconcile'].create({
+            'name': 'benchmark %s' % method,
+            'account': account.id,
+            'reconcile_method': [(0, 0, {'name': method})],
+        })
+        start = time.time()
+        task.run_reconcile()
+        wall_time = time.time() - start
+        history = task.last_history
+        result = dict.fromkeys(
+            ('lines_fetched', 'comparisons', 'groups', 'reconcile_calls',
+             'commits', 'query_time', 'matching_time', 'write_time'), 0)
+        result.update({
+            'wall_time': wall_time,
+            'reconciled_lines': len(history.reconcile_line_ids),
+            # a failed run records a history without metrics
+            'failed': not history.stat_ids,
+        })
+        for stat in history.stat_ids:
+            result.update({
+                'lines_fetched': stat.lines_fetched,
+                'comparisons': stat.comparisons,
+                'groups': stat.groups,
+                'reconcile_calls': stat.reconcile_calls,
+                'commits': stat.commits,
+                'query_time': stat.query_time,
+                'matching_time': stat.matching_time,
+                'write_time': stat.write_time,
+            })
+        return result
+
+    def _benchmark_size(self, size):
+        ledger = SyntheticLedger(
+            self.env, size, partner_count=self.partner_count,
+            ref_count=self.ref_count, match_rate=self.match_rate,
+        )
+        start = time.time()
+        account = ledger.generate()
+        report = {
+            'lines': size,
+            'partners': self.partner_count,
+            'refs': self.ref_count,
+            'match_rate': self.match_rate,
+            'generation_time': time.time() - start,
+            'methods': {},
+        }
+        # the methods of all the installed modules, deep searches included
+        methods = self.env['account.mass.reconcile.method']._selection_name()
+        for method, dummy in methods:
+            self.env.cr.execute('SAVEPOINT mass_reconcile_benchmark_method')
+            try:
+                report['methods'][method] = self._run_method(account, method)
+            finally:
+                self._rollback_to('mass_reconcile_benchmark_method')
+            _logger.info("benchmark %s on %d lines: %s",
+                         method, size, report['methods'][method])
+        return report
+
+    def test_benchmark(self):
+        reports = []
+        for size in self.sizes:
+            self.env.cr.execute('SAVEPOINT mass_reconcile_benchmark_ledger')
+            try:
+                reports.append(self._benchmark_size(size))
+            finally:
+                self._rollback_to('mass_reconcile_benchmark_ledger')
+        with open(self.report_path, 'w') as report_file:
+            json.dump(reports, report_file, indent=2, sort_keys=True)
+        _logger.info("mass reconcile benchmark report written to %s",
+                     self.report_path)
+        for report in reports:
+            for method, result in report['methods'].items():
+                self.assertTrue(result['lines_fetched'] <= report['lines'],
+                                method)
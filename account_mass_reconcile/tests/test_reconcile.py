@@ -1,8 +1,10 @@
 # © 2014-2016 Camptocamp SA (Damien Crier)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+from datetime import timedelta
+
 from odoo.tests import common
-from odoo import fields, exceptions, tools
+from odoo import fields, exceptions, sql_db, tools
 from odoo.modules import get_module_resource
 
 
@@ -58,3 +60,137 @@ class TestReconcile(common.SavepointCase):
         res = self.mass_rec._prepare_run_transient(self.mass_rec_method)
         self.assertEqual(self.ref('account.a_salary_expense'),
                          res.get('account_id', 0))
+
+    def test_incremental_changed_since(self):
+        now = fields.Datetime.now()
+        self.mass_rec.write({
+            'incremental': True,
+            'full_run_interval': 7,
+            'watermark': now - timedelta(hours=1),
+            'last_full_run': now - timedelta(days=1),
+        })
+        self.assertEqual(self.mass_rec.watermark,
+                         self.mass_rec._get_changed_since())
+        res = self.mass_rec._prepare_run_transient(self.mass_rec_method)
+        res['changed_since'] = self.mass_rec.watermark
+        rec = self.env[self.mass_rec_method.name].create(res)
+        where, params = rec._where_query()
+        self.assertIn('write_date > %s', where)
+        self.assertEqual(self.mass_rec.watermark, params[-1])
+        # a full run is due
+        self.mass_rec.last_full_run = now - timedelta(days=8)
+        self.assertFalse(self.mass_rec._get_changed_since())
+        # a change in the methods forces a full run
+        self.mass_rec.last_full_run = now - timedelta(days=1)
+        self.mass_rec_method.write_off = 1.
+        self.assertFalse(self.mass_rec.watermark)
+        self.assertFalse(self.mass_rec._get_changed_since())
+
+    def test_watermark(self):
+        self.env.cr.execute("SELECT now() AT TIME ZONE 'UTC'")
+        now = self.env.cr.fetchone()[0]
+        self.mass_rec.watermark_overlap = 10
+        # the lines written by the transactions running before the start
+        # of the run are read again by the next run
+        self.assertLessEqual(self.mass_rec._get_run_start(),
+                             now - timedelta(minutes=10))
+        # the lines of another account have to be reconciled by a full run
+        self.mass_rec.watermark = now
+        self.mass_rec.account = self.env.ref('account.a_recv')
+        self.assertFalse(self.mass_rec.watermark)
+        self.mass_rec.watermark = now
+        self.mass_rec.write({
+            'profile_type': 'multi',
+            'account_ids': [(6, 0, self.mass_rec.account.ids)],
+        })
+        self.assertFalse(self.mass_rec.watermark)
+
+    def test_incremental_run(self):
+        self.mass_rec.incremental = True
+        self.mass_rec.run_reconcile()
+        self.assertTrue(self.mass_rec.watermark)
+        self.assertEqual(self.mass_rec.watermark,
+                         self.mass_rec.last_full_run)
+        self.assertEqual(self.mass_rec.watermark,
+                         self.mass_rec._get_changed_since())
+
+    def test_scheduler_priority(self):
+        now = fields.Datetime.now()
+        later = now + timedelta(hours=10)
+        self.assertGreater(self.mass_rec._scheduler_priority(later),
+                           self.mass_rec._scheduler_priority(now))
+        self.mass_rec_no_history.scheduler_weight = 2.
+        self.assertGreater(
+            self.mass_rec_no_history._scheduler_priority(later),
+            self.mass_rec._scheduler_priority(later)
+        )
+
+    def test_claim(self):
+        claim_cr = self.mass_rec._claim()
+        self.assertIsNotNone(claim_cr)
+        self.assertTrue(self.mass_rec.claimed_by)
+        self.mass_rec._release(claim_cr)
+        self.mass_rec.invalidate_cache(['claimed_by'])
+        self.assertFalse(self.mass_rec.claimed_by)
+        # another worker holds a task on the same account
+        other_cr = sql_db.db_connect(self.env.cr.dbname).cursor()
+        try:
+            other_cr.execute("SELECT pg_advisory_lock(hashtext(%s), %s)",
+                             (self.mass_rec._claim_account_lock_key,
+                              self.mass_rec.account.id))
+            self.assertIsNone(self.mass_rec_no_history._claim())
+            # a manual run does not collide with the worker either
+            with self.assertRaises(exceptions.UserError):
+                self.mass_rec_no_history.run_reconcile()
+        finally:
+            other_cr.execute("SELECT pg_advisory_unlock_all()")
+            other_cr.close()
+        claim_cr = self.mass_rec_no_history._claim()
+        self.assertIsNotNone(claim_cr)
+        self.mass_rec_no_history._release(claim_cr)
+
+    def test_set_based_computes(self):
+        tasks = self.mass_rec | self.mass_rec_no_history
+        self.assertEqual(self.rec_history, tasks.mapped('last_history'))
+        tasks._invalidate_unreconciled_count()
+        count = self.env['account.move.line'].search_count([
+            ('account_id', '=', self.mass_rec.account.id),
+            ('reconciled', '=', False),
+        ])
+        self.assertEqual([count, count], tasks.mapped('unreconciled_count'))
+
+    def test_resume_interrupted_run(self):
+        second_method = self.mass_rec_method_obj.create({
+            'name': 'mass.reconcile.simple.partner',
+            'sequence': '20',
+            'task_id': self.mass_rec.id,
+        })
+        history = self.mass_rec._start_history()
+        history.write({
+            'checkpoint_method_id': second_method.id,
+            'checkpoint_position': 42,
+        })
+        self.assertEqual(history, self.mass_rec._get_interrupted_history())
+        self.mass_rec.resume_interrupted = True
+        self.mass_rec.run_reconcile()
+        self.assertEqual('done', history.state)
+        self.assertFalse(history.checkpoint_method_id)
+        self.assertFalse(self.mass_rec._get_interrupted_history())
+        # the methods before the checkpoint are not run again
+        self.assertEqual(['mass.reconcile.simple.partner'],
+                         history.stat_ids.mapped('name'))
+
+    def test_interrupted_run_not_resumed(self):
+        history = self.mass_rec._start_history()
+        history.write({
+            'checkpoint_method_id': self.mass_rec_method.id,
+            'checkpoint_position': 42,
+        })
+        self.mass_rec.run_reconcile()
+        # the interrupted run is closed, a new run starts from the
+        # first method
+        self.assertEqual('failed', history.state)
+        self.mass_rec.invalidate_cache()
+        self.assertNotEqual(history, self.mass_rec.last_history)
+        self.assertEqual('done', self.mass_rec.last_history.state)
+        self.assertFalse(self.mass_rec._get_interrupted_history())
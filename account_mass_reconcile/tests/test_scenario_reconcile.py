@@ -1,9 +1,19 @@
 # © 2014-2016 Camptocamp SA (Damien Crier)
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
 
+import unittest
+from unittest import mock
+
 from odoo.tests import common
 from odoo import fields, tools
+from odoo.exceptions import ValidationError
 from odoo.modules import get_module_resource
+from odoo.addons.account_mass_reconcile.models.base_advanced_reconciliation \
+    import ReconcileGroups
+from odoo.addons.account_mass_reconcile.models.base_reconciliation \
+    import MoveLineRow
+from odoo.addons.account_mass_reconcile.models.candidate_columns \
+    import numpy
 
 
 class TestScenarioReconcile(common.SavepointCase):
@@ -130,6 +140,13 @@ class TestScenarioReconcile(common.SavepointCase):
             'paid',
             invoice.state
         )
+        history = mass_rec.last_history
+        self.assertTrue(history.reconcile_ids)
+        self.assertEqual(history.reconcile_ids.mapped('reconciled_line_ids'),
+                         history.reconcile_line_ids)
+        self.assertEqual(len(history.reconcile_ids), history.reconcile_count)
+        self.assertEqual(len(history.reconcile_line_ids),
+                         history.reconcile_line_count)
 
     def test_scenario_reconcile_currency(self):
         # create currency rate
@@ -225,3 +242,538 @@ class TestScenarioReconcile(common.SavepointCase):
             'paid',
             invoice.state
         )
+
+    @staticmethod
+    def _legacy_reconcile_groups(matches):
+        """ Grouping of the matches as done before the union-find """
+        reconcile_groups = []
+        for line_ids in matches:
+            opposite_ids = line_ids[1:]
+            for group in reconcile_groups:
+                if any([lid in group for lid in opposite_ids]):
+                    group.update(line_ids)
+                    break
+            else:
+                reconcile_groups.append(set(line_ids))
+        return reconcile_groups
+
+    def _assert_groups_consistent(self, matches):
+        legacy_groups = self._legacy_reconcile_groups(matches)
+        groups = ReconcileGroups()
+        for line_ids in matches:
+            groups.union(line_ids)
+        reconcile_groups = groups.groups()
+        all_ids = set(lid for line_ids in matches for lid in line_ids)
+        # the groups are disjoint and contain every matched line
+        self.assertEqual(len(all_ids),
+                         sum(len(group) for group in reconcile_groups))
+        self.assertEqual(all_ids, set().union(*reconcile_groups))
+        # every legacy group is contained in exactly one group
+        for legacy_group in legacy_groups:
+            self.assertEqual(1, len([group for group in reconcile_groups
+                                     if legacy_group <= group]))
+        # when the legacy groups were disjoint, the groups are the same
+        if sum(len(group) for group in legacy_groups) == len(all_ids):
+            self.assertEqual(
+                sorted(sorted(group) for group in legacy_groups),
+                sorted(sorted(group) for group in reconcile_groups))
+        return legacy_groups, reconcile_groups
+
+    def _create_unreconciled_payments(self, amounts):
+        """ Create an open invoice of 1000.0 and bank statement lines
+        of the given amounts with the number of the invoice, left
+        unreconciled on the receivable account
+        """
+        invoice = self.invoice_obj.create(
+            {
+                'type': 'out_invoice',
+                'account_id': self.ref('account.a_recv'),
+                'company_id': self.ref('base.main_company'),
+                'journal_id': self.ref('account.sales_journal'),
+                'partner_id': self.ref('base.res_partner_12'),
+                'invoice_line_ids': [
+                    (0, 0, {
+                        'name': '[PCSC234] PC Assemble SC234',
+                        'account_id': self.ref('account.a_sale'),
+                        'price_unit': 1000.0,
+                        'quantity': 1.0,
+                        'product_id': self.ref('product.product_product_3'),
+                    }
+                    )
+                ]
+            }
+        )
+        invoice.action_invoice_open()
+        statement = self.bk_stmt_obj.create(
+            {
+                'balance_end_real': 0.0,
+                'balance_start': 0.0,
+                'date': fields.Date.today(),
+                'journal_id': self.ref('account.bank_journal'),
+                'line_ids': [
+                    (0, 0, {
+                        'amount': amount,
+                        'partner_id': self.ref('base.res_partner_12'),
+                        'name': invoice.number,
+                        'ref': invoice.number,
+                    }) for amount in amounts
+                ]
+            }
+        )
+        line_id = invoice.move_id.line_ids.filtered(
+            lambda l: l.account_id.id == self.ref('account.a_recv'))
+        for statement_line in statement.line_ids:
+            statement_line.process_reconciliation(
+                [
+                    {
+                        'move_line': line_id,
+                        'credit': statement_line.amount,
+                        'debit': 0.0,
+                        'name': invoice.number,
+                    }
+                ]
+            )
+        lines_to_unreconcile = self.acc_move_line_obj.search(
+            [('reconciled', '=', True),
+             ('statement_id', '=', statement.id)]
+        )
+        lines_to_unreconcile.remove_move_reconcile()
+        return invoice
+
+    def test_scenario_reconcile_in_database(self):
+        invoice = self._create_unreconciled_payments([1000.0])
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                        'pair_in_database': True,
+                    })
+                ]
+            }
+        )
+        mass_rec.run_reconcile()
+        self.assertEqual(
+            'paid',
+            invoice.state
+        )
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_scenario_reconcile_columnar(self):
+        invoice = self._create_unreconciled_payments([1000.0])
+        company = self.env.user.company_id
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.advanced.ref',
+                        'sequence': 1,
+                    }),
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                        'sequence': 2,
+                    }),
+                ]
+            }
+        )
+        rec = self.env['mass.reconcile.simple.partner'].create(
+            {'account_id': self.ref('account.a_recv'),
+             'date_base_on': 'newest'}
+        )
+        snapshot = mass_rec._get_candidate_snapshot()
+        self.assertIsNone(snapshot.columns)
+        groups = [
+            [line for line in snapshot.lines
+             if line['partner_id'] == partner_id]
+            for partner_id in set(line['partner_id']
+                                  for line in snapshot.lines)
+        ]
+
+        def group_totals(rec):
+            # the sums of the arrays can differ in the last digits
+            return [(below, round(debit, 2), round(credit, 2), rec_date)
+                    for below, debit, credit, rec_date
+                    in rec._group_totals(groups)]
+
+        totals = group_totals(rec)
+
+        company.reconciliation_columnar = True
+        columnar_snapshot = mass_rec._get_candidate_snapshot()
+        self.assertTrue(columnar_snapshot.columns is not None)
+        self.assertEqual(snapshot.lines, columnar_snapshot.lines)
+        # the rows are built once for the reads of a method
+        self.assertIs(columnar_snapshot.lines, columnar_snapshot.lines)
+        rec_columnar = rec.with_context(
+            mass_reconcile_snapshot=columnar_snapshot
+        )
+        # the few groups are not worth the arrays
+        self.assertEqual(totals, group_totals(rec_columnar))
+        with mock.patch.object(type(rec), '_columns_min_groups', 1):
+            self.assertEqual(totals, group_totals(rec))
+            self.assertEqual(totals, group_totals(rec_columnar))
+
+        mass_rec.run_reconcile()
+        self.assertEqual(
+            'paid',
+            invoice.state
+        )
+
+    def test_scenario_reconcile_multi_account(self):
+        invoice = self._create_unreconciled_payments([1000.0])
+        accounts = self.env.ref('account.a_recv') | self.env.ref(
+            'account.a_pay')
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'profile_type': 'multi',
+                'account_ids': [(6, 0, accounts.ids)],
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                    })
+                ]
+            }
+        )
+        self.assertEqual(accounts, mass_rec._get_accounts())
+        snapshots = mass_rec._get_candidate_snapshots(accounts)
+        self.assertEqual(set(accounts.ids), set(snapshots))
+        for account in accounts:
+            self.assertTrue(all(
+                line['account_id'] == account.id
+                for line in snapshots[account.id].lines
+            ))
+        self.assertTrue(snapshots[self.ref('account.a_recv')].lines)
+        self.assertTrue(mass_rec.unreconciled_count >=
+                        len(snapshots[self.ref('account.a_recv')]))
+
+        mass_rec.run_reconcile()
+        self.assertEqual('paid', invoice.state)
+        history = mass_rec.last_history
+        # one history with the metrics of the method on each account
+        self.assertEqual(1, len(mass_rec.history_ids))
+        self.assertEqual(accounts, history.stat_ids.mapped('account_id'))
+        recv_stat = history.stat_ids.filtered(
+            lambda stat: stat.account_id == self.env.ref('account.a_recv')
+        )
+        self.assertTrue(recv_stat.reconciled_lines >= 2)
+        self.assertFalse(history.checkpoint_account_id)
+
+    def test_profile_accounts_required(self):
+        with self.assertRaises(ValidationError):
+            self.mass_rec_obj.create({
+                'name': 'mass_reconcile_1',
+                'profile_type': 'multi',
+                'account': self.ref('account.a_recv'),
+            })
+
+    def test_scenario_simulate(self):
+        invoice = self._create_unreconciled_payments([1000.0])
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                        'sequence': 1,
+                    }),
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                        'sequence': 2,
+                        'pair_in_database': True,
+                    }),
+                ]
+            }
+        )
+        action = mass_rec.simulate_reconcile()
+        simulation = self.env['mass.reconcile.simulation'].browse(
+            action['res_id'])
+        # nothing is reconciled and the lines are proposed once
+        self.assertEqual('open', invoice.state)
+        self.assertFalse(mass_rec.history_ids)
+        self.assertEqual(1, simulation.proposal_count)
+        proposal = simulation.line_ids
+        self.assertEqual('mass.reconcile.simple.partner', proposal.method)
+        self.assertTrue(proposal.full)
+        self.assertEqual(1000.0, proposal.debit)
+        self.assertEqual(1000.0, proposal.credit)
+        self.assertEqual(self.env.ref('base.res_partner_12'),
+                         proposal.partner_id)
+        mass_rec.run_reconcile()
+        self.assertEqual(proposal.move_line_ids,
+                         mass_rec.last_history.reconcile_line_ids)
+
+    def test_scenario_reconcile_streaming(self):
+        self.env.ref('base.main_company').reconciliation_fetch_chunk_size = 1
+        invoice = self._create_unreconciled_payments([1000.0])
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                    })
+                ]
+            }
+        )
+        mass_rec.run_reconcile()
+        self.assertEqual(
+            'paid',
+            invoice.state
+        )
+
+    def test_fetch_rows(self):
+        self._create_unreconciled_payments([1000.0])
+        rec = self.env['mass.reconcile.advanced.ref'].create(
+            {'account_id': self.ref('account.a_recv')}
+        )
+        query = ' '.join((rec._select_query(), rec._from_query(),
+                          rec._where_query()[0],
+                          "ORDER BY account_move_line.id"))
+        params = rec._where_query()[1]
+        self.env.cr.execute(query, params)
+        expected = self.env.cr.dictfetchall()
+        lines = rec._fetch_lines(query, params)
+        self.assertTrue(lines)
+        self.assertTrue(all(isinstance(l, MoveLineRow) for l in lines))
+        self.assertEqual(expected, lines)
+        line = lines[0]
+        self.assertEqual(expected[0]['id'], line['id'])
+        self.assertEqual(sorted(expected[0]), sorted(line.keys()))
+        self.assertIsNone(line.get('key'))
+        with self.assertRaises(KeyError):
+            line['key']
+        # read by chunks through a server-side cursor
+        self.env.ref('base.main_company').reconciliation_fetch_chunk_size = 1
+        self.assertEqual(expected, list(rec._fetch_lines(query, params)))
+        # the cursor is closed once the lines are read
+        self.env.cr.execute(
+            "SELECT count(*) FROM pg_cursors "
+            "WHERE name LIKE 'mass\\_reconcile\\_%'"
+        )
+        self.assertEqual(0, self.env.cr.fetchone()[0])
+
+    def test_scenario_reconcile_snapshot(self):
+        invoice = self._create_unreconciled_payments([1000.0])
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.advanced.ref',
+                        'sequence': 1,
+                    }),
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                        'sequence': 2,
+                    }),
+                ]
+            }
+        )
+        snapshot = mass_rec._get_candidate_snapshot()
+        rec = self.env['mass.reconcile.advanced.ref'].create(
+            {'account_id': self.ref('account.a_recv')}
+        )
+        rec_snapshot = rec.with_context(mass_reconcile_snapshot=snapshot)
+        self.assertEqual(snapshot, rec_snapshot._get_snapshot())
+        self.assertEqual(
+            sorted(l['id'] for l in rec._query_debit()),
+            sorted(l['id'] for l in rec_snapshot._query_debit())
+        )
+        self.assertEqual(
+            sorted(l['id'] for l in rec._query_credit()),
+            sorted(l['id'] for l in rec_snapshot._query_credit())
+        )
+        rec._filter = "[('partner_id', '!=', False)]"
+        self.assertIsNone(rec_snapshot._get_snapshot())
+
+        mass_rec.run_reconcile()
+        self.assertEqual(
+            'paid',
+            invoice.state
+        )
+        stats = mass_rec.last_history.stat_ids
+        self.assertEqual(
+            ['mass.reconcile.advanced.ref', 'mass.reconcile.simple.partner'],
+            stats.mapped('name')
+        )
+        self.assertTrue(stats[0].lines_fetched)
+        self.assertTrue(sum(stats.mapped('groups')))
+        self.assertEqual(sum(stats.mapped('groups')),
+                         sum(stats.mapped('reconcile_calls')))
+
+    def test_scenario_reconcile_snapshot_partial(self):
+        # the payment is used up by a partial reconciliation of the
+        # advanced method, it must not be given to the next method
+        invoice = self._create_unreconciled_payments([600.0])
+        other_invoice = self.invoice_obj.create(
+            {
+                'type': 'out_invoice',
+                'account_id': self.ref('account.a_recv'),
+                'company_id': self.ref('base.main_company'),
+                'journal_id': self.ref('account.sales_journal'),
+                'partner_id': self.ref('base.res_partner_12'),
+                'invoice_line_ids': [
+                    (0, 0, {
+                        'name': '[PCSC234] PC Assemble SC234',
+                        'account_id': self.ref('account.a_sale'),
+                        'price_unit': 600.0,
+                        'quantity': 1.0,
+                        'product_id': self.ref('product.product_product_3'),
+                    })
+                ]
+            }
+        )
+        other_invoice.action_invoice_open()
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.advanced.ref',
+                        'sequence': 1,
+                    }),
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                        'sequence': 2,
+                    }),
+                ]
+            }
+        )
+        mass_rec.run_reconcile()
+        self.assertEqual(400.0, invoice.residual)
+        self.assertEqual('open', other_invoice.state)
+        # no error history
+        self.assertEqual(1, len(mass_rec.history_ids))
+        self.assertEqual(
+            ['mass.reconcile.advanced.ref', 'mass.reconcile.simple.partner'],
+            mass_rec.last_history.stat_ids.mapped('name')
+        )
+
+    def test_partner_shards(self):
+        self._create_unreconciled_payments([600.0, 400.0])
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+            }
+        )
+        partners = self.acc_move_line_obj.search(
+            [('account_id', '=', self.ref('account.a_recv')),
+             ('reconciled', '=', False)]
+        ).mapped('partner_id')
+        shards = mass_rec._get_partner_shards(3)
+        self.assertTrue(0 < len(shards) <= 3)
+        self.assertEqual(
+            sorted(partners.ids),
+            sorted(pid for shard in shards for pid in shard)
+        )
+
+    def test_scenario_reconcile_sharded(self):
+        invoice = self._create_unreconciled_payments([1000.0])
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+                'shard_workers': 2,
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                    })
+                ]
+            }
+        )
+        # the shards are matched in the process of the test
+        self.assertIsNone(mass_rec._shard_process_pool())
+        mass_rec.run_reconcile()
+        invoice.invalidate_cache()
+        mass_rec.invalidate_cache()
+        self.assertEqual('paid', invoice.state)
+        history = mass_rec.last_history
+        self.assertEqual('done', history.state)
+        self.assertTrue(history.reconcile_ids)
+        stat = history.stat_ids
+        self.assertEqual('mass.reconcile.simple.partner', stat.name)
+        self.assertTrue(stat.groups)
+        self.assertEqual(stat.groups, stat.reconcile_calls)
+        # the run is not committed without a commit interval
+        self.assertFalse(stat.commits)
+
+    def test_scenario_reconcile_sharded_failure(self):
+        invoice = self._create_unreconciled_payments([1000.0])
+        mass_rec = self.mass_rec_obj.create(
+            {
+                'name': 'mass_reconcile_1',
+                'account': self.ref('account.a_recv'),
+                'shard_workers': 2,
+                'reconcile_method': [
+                    (0, 0, {
+                        'name': 'mass.reconcile.simple.partner',
+                        'sequence': 1,
+                    }),
+                    (0, 0, {
+                        'name': 'mass.reconcile.advanced.ref',
+                        'sequence': 2,
+                    }),
+                ]
+            }
+        )
+        rec_class = type(self.env['mass.reconcile.advanced.ref'])
+        with mock.patch.object(rec_class, '_reconcile_proposals',
+                               side_effect=Exception('shard failure')):
+            mass_rec.run_reconcile()
+        invoice.invalidate_cache()
+        mass_rec.invalidate_cache()
+        # without commit, the whole run is rolled back and its failure
+        # is recorded on the history of the run only
+        self.assertEqual('open', invoice.state)
+        history = mass_rec.history_ids
+        self.assertEqual(1, len(history))
+        self.assertEqual('failed', history.state)
+        self.assertFalse(history.reconcile_ids)
+        self.assertEqual(['mass.reconcile.simple.partner',
+                          'mass.reconcile.advanced.ref'],
+                         history.stat_ids.sorted('sequence').mapped('name'))
+
+    def test_scenario_reconcile_groups(self):
+        # the invoice is paid in two times
+        self._create_unreconciled_payments([600.0, 400.0])
+        rec = self.env['mass.reconcile.advanced.ref'].create(
+            {'account_id': self.ref('account.a_recv')}
+        )
+        debit_lines = rec._query_debit()
+        matches = []
+        for credit_line in rec._query_credit():
+            if rec._skip_line(credit_line):
+                continue
+            opposite_lines = rec._search_opposites(credit_line, debit_lines)
+            if opposite_lines:
+                matches.append([credit_line['id']] +
+                               [l['id'] for l in opposite_lines])
+        self._assert_groups_consistent(matches)
+
+        # a credit line matching the lines of 2 groups has to merge them,
+        # the legacy grouping added it to the first group only and kept
+        # the lines of the second group in 2 groups
+        max_id = max([lid for line_ids in matches for lid in line_ids] +
+                     [0])
+        debit_1, debit_2, credit_1, credit_2, credit_3 = range(
+            max_id + 1, max_id + 6)
+        matches += [
+            [credit_1, debit_1],
+            [credit_2, debit_2],
+            [credit_3, debit_1, debit_2],
+        ]
+        legacy_groups, reconcile_groups = self._assert_groups_consistent(
+            matches)
+        self.assertEqual(2, len([group for group in legacy_groups
+                                 if debit_2 in group]))
+        self.assertIn({debit_1, debit_2, credit_1, credit_2, credit_3},
+                      reconcile_groups)
@@ -0,0 +1,194 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+import random
+from unittest import mock
+
+from odoo.tests import common
+
+
+def legacy_rec_auto_lines_simple(rec, lines):
+    """ Pairing of the simple methods as done before the buckets """
+    count = 0
+    res = []
+    while (count < len(lines)):
+        for i in range(count + 1, len(lines)):
+            if lines[count][rec._key_field] != lines[i][rec._key_field]:
+                break
+            check = False
+            if lines[count]['credit'] > 0 and lines[i]['debit'] > 0:
+                credit_line = lines[count]
+                debit_line = lines[i]
+                check = True
+            elif lines[i]['credit'] > 0 and lines[count]['debit'] > 0:
+                credit_line = lines[i]
+                debit_line = lines[count]
+                check = True
+            if not check:
+                continue
+            reconciled, dummy = rec._reconcile_lines(
+                [credit_line, debit_line],
+                allow_partial=False
+                )
+            if reconciled:
+                res += [credit_line['id'], debit_line['id']]
+                del lines[i]
+                break
+        count += 1
+    return res
+
+
+class TestSimpleReconcile(common.SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSimpleReconcile, cls).setUpClass()
+        cls.account = cls.env['account.account'].search([], limit=1)
+
+    @staticmethod
+    def _fake_reconcile_lines(rec, lines, allow_partial=False):
+        below_writeoff, dummy, dummy = rec._below_writeoff_limit(
+            lines, rec.write_off)
+        return below_writeoff, below_writeoff
+
+    def _generate_lines(self, key_field, count):
+        keys = {
+            'name': ['INV/1', 'INV/2', 'INV/3'],
+            'partner_id': [1, 2, 3],
+            'ref': ['REF1', 'REF2', 'REF3'],
+        }[key_field]
+        lines = []
+        for line_id in range(1, count + 1):
+            amount = random.choice([10., 10.01, 12.5, 20., 100.])
+            is_debit = random.random() < 0.5
+            lines.append({
+                'id': line_id,
+                key_field: random.choice(keys),
+                'debit': amount if is_debit else 0.,
+                'credit': 0. if is_debit else amount,
+                'date': '2019-01-01',
+            })
+        lines.sort(key=lambda line: line[key_field])
+        return lines
+
+    def test_same_pairs_as_legacy(self):
+        random.seed(42)
+        for model in ('mass.reconcile.simple.name',
+                      'mass.reconcile.simple.partner',
+                      'mass.reconcile.simple.reference'):
+            rec_model = self.env[model]
+            with mock.patch.object(type(rec_model), '_reconcile_lines',
+                                   self._fake_reconcile_lines):
+                for write_off in (0., 0.01, 5.):
+                    rec = rec_model.create({
+                        'account_id': self.account.id,
+                        'write_off': write_off,
+                    })
+                    lines = self._generate_lines(rec._key_field, 60)
+                    self.assertEqual(
+                        legacy_rec_auto_lines_simple(rec, list(lines)),
+                        rec.rec_auto_lines_simple(lines),
+                    )
+
+    def test_closest_amount(self):
+        rec_model = self.env['mass.reconcile.simple.partner.closest']
+        lines = [
+            {'id': 1, 'partner_id': 1, 'debit': 100., 'credit': 0.,
+             'date': '2019-01-01'},
+            {'id': 2, 'partner_id': 1, 'debit': 99., 'credit': 0.,
+             'date': '2019-01-01'},
+            {'id': 3, 'partner_id': 1, 'debit': 0., 'credit': 99.,
+             'date': '2019-01-01'},
+            {'id': 4, 'partner_id': 1, 'debit': 0., 'credit': 50.,
+             'date': '2019-01-01'},
+        ]
+        with mock.patch.object(type(rec_model), '_reconcile_lines',
+                               self._fake_reconcile_lines):
+            rec = rec_model.create({
+                'account_id': self.account.id,
+                'write_off': 1.,
+            })
+            # the simple method pairs the credit with the first debit
+            # within the write-off, here with the closest amount
+            self.assertEqual([3, 2], rec.rec_auto_lines_simple(lines))
+
+    def _closest_pairs(self, debits, credits, write_off):
+        """ Pairs of the closest method, the debit lines having the ids
+        from 1 and the credit lines the ids from 101
+        """
+        lines = [
+            {'id': line_id, 'partner_id': 1, 'debit': amount,
+             'credit': 0., 'date': '2019-01-01'}
+            for line_id, amount in enumerate(debits, 1)
+        ] + [
+            {'id': line_id, 'partner_id': 1, 'debit': 0.,
+             'credit': amount, 'date': '2019-01-01'}
+            for line_id, amount in enumerate(credits, 101)
+        ]
+        rec_model = self.env['mass.reconcile.simple.partner.closest']
+        with mock.patch.object(type(rec_model), '_reconcile_lines',
+                               self._fake_reconcile_lines):
+            rec = rec_model.create({
+                'account_id': self.account.id,
+                'write_off': write_off,
+            })
+            return rec.rec_auto_lines_simple(lines)
+
+    def test_closest_amount_ties(self):
+        # the debit lines of the same amount are used in their order
+        self.assertEqual(
+            [101, 1, 102, 2, 103, 3],
+            self._closest_pairs([100., 100., 100.], [100., 100., 100.], 0.)
+        )
+        # as close above and below, the larger amount is used
+        self.assertEqual(
+            [101, 2, 102, 1],
+            self._closest_pairs([99.99, 100.01], [100., 100.], 0.01)
+        )
+        self.assertEqual(
+            [101, 2, 102, 3, 103, 1],
+            self._closest_pairs([99.99, 100.01, 100.01], [100.] * 3, 0.01)
+        )
+
+    def test_closest_amount_around(self):
+        # a debit amount just above the credit amount
+        self.assertEqual(
+            [101, 2],
+            self._closest_pairs([99.98, 100.01], [100.], 0.05)
+        )
+        # a debit amount just below the credit amount
+        self.assertEqual(
+            [101, 1],
+            self._closest_pairs([99.99, 100.02], [100.], 0.05)
+        )
+        # outside of the write-off
+        self.assertEqual([], self._closest_pairs([99.99, 100.01], [100.], 0.))
+        # the reconciled debit lines are skipped on both sides
+        self.assertEqual(
+            [101, 2, 102, 1, 103, 3, 104, 4],
+            self._closest_pairs([99.99, 100.01, 100.02, 99.97],
+                                [100.] * 4, 0.05)
+        )
+
+    def test_deferred_writes(self):
+        random.seed(42)
+        rec = self.env['mass.reconcile.simple.partner'].create({
+            'account_id': self.account.id,
+        })
+        lines = self._generate_lines(rec._key_field, 60)
+        batches = []
+        with mock.patch.object(
+                type(rec), '_write_reconciliations', autospec=True,
+                side_effect=lambda rec, groups: batches.append(list(groups))
+        ), mock.patch.object(type(rec), '_write_batch_size', 2):
+            res = rec.rec_auto_lines_simple(lines)
+        self.assertTrue(res)
+        # the pairs are written by batches, not one by one
+        self.assertTrue(all(len(batch) <= 2 for batch in batches))
+        self.assertLess(len(batches), len(res) // 2)
+        self.assertEqual(
+            sorted(res),
+            sorted(line_id for batch in batches
+                   for line_ids, dummy, dummy in batch
+                   for line_id in line_ids)
+        )
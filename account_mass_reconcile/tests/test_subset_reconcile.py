@@ -0,0 +1,59 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+
+from itertools import combinations
+
+from odoo.tests import common
+
+
+class TestSubsetReconcile(common.SavepointCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestSubsetReconcile, cls).setUpClass()
+        cls.rec_model = cls.env['mass.reconcile.subset.partner']
+
+    def _line(self, line_id, debit=0., credit=0.):
+        return {'id': line_id, 'partner_id': 1, 'debit': debit,
+                'credit': credit}
+
+    def test_search_strategies(self):
+        amounts = [9000, 5000, 1234, 999, 999, 250, 100, 100]
+        for target in (100, 1099, 1349, 6233, 7, 17682, 20000):
+            expected = any(
+                sum(combination) == target
+                for size in range(1, len(amounts) + 1)
+                for combination in combinations(amounts, size)
+            )
+            for subset in (
+                    self.rec_model._subset_meet_in_middle(
+                        amounts, target, target),
+                    self.rec_model._subset_depth_first(
+                        amounts, target, target, 10000)[0]):
+                self.assertEqual(expected, subset is not None, target)
+                if subset is not None:
+                    self.assertEqual(
+                        target, sum(amounts[idx] for idx in subset))
+
+    def test_iteration_cap(self):
+        amounts = list(range(1000, 0, -1))
+        subset, iterations = self.rec_model._subset_depth_first(
+            amounts, 10 ** 7, 10 ** 7, 50)
+        self.assertIsNone(subset)
+        self.assertLessEqual(iterations, 51)
+
+    def test_match_partner_lines(self):
+        rec = self.rec_model.new({'write_off': 0.})
+        lines = [
+            self._line(1, debit=100.),
+            self._line(2, debit=250.5),
+            self._line(3, debit=49.5),
+            self._line(4, debit=1000.),
+            self._line(5, credit=300.),
+            self._line(6, credit=150.),
+            self._line(7, credit=1000.),
+        ]
+        groups = rec._match_partner_lines(lines)
+        self.assertEqual([[5, 2, 3], [7, 4]],
+                         [[line['id'] for line in group]
+                          for group in groups])
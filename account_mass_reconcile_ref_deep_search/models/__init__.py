@@ -1,2 +1,3 @@
+from . import account_move_line
 from . import mass_reconcile
 from . import advanced_reconciliation
@@ -0,0 +1,37 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+import logging
+
+import psycopg2
+
+from odoo import api, models
+from odoo.tools.sql import index_exists
+
+_logger = logging.getLogger(__name__)
+
+
+class AccountMoveLine(models.Model):
+    _inherit = 'account.move.line'
+
+    @api.model_cr
+    def init(self):
+        # used by the deep search in database to find the unreconciled
+        # lines whose ref or name contain the ref of a credit line
+        try:
+            with self._cr.savepoint():
+                self._cr.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        except psycopg2.Error:
+            _logger.warning(
+                "The pg_trgm extension cannot be created, the deep search "
+                "in database will search the refs in memory. Create it "
+                "with a superuser to enable it."
+            )
+            return
+        for column in ('ref', 'name'):
+            index_name = 'account_move_line_%s_trgm_index' % column
+            if not index_exists(self._cr, index_name):
+                self._cr.execute(
+                    "CREATE INDEX %s ON account_move_line "
+                    "USING gin (lower(%s) gin_trgm_ops) "
+                    "WHERE NOT reconciled" % (index_name, column)
+                )
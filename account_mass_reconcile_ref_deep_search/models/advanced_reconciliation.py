@@ -1,8 +1,25 @@
 # Copyright 2015-2019 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
-from odoo import _, models
+import logging
 from itertools import product
 
+from odoo import _, api, models
+
+from odoo.addons.account_mass_reconcile.models.advanced_reconciliation \
+    import MassReconcileAdvancedRef
+from odoo.addons.account_mass_reconcile.models.base_advanced_reconciliation \
+    import MassReconcileAdvanced
+
+from .ref_automaton import RefAutomaton
+
+_logger = logging.getLogger(__name__)
+
+# SQL string of the characters removed by str.strip(), so the refs are
+# trimmed by the database as by `_matchers`
+_STRIP_CHARS = "E'%s'" % ''.join(
+    '\\u%04x' % code for code in range(0x10000) if chr(code).isspace()
+)
+
 
 class MassReconciledAdvancedRefDeepSearch(models.TransientModel):
 
@@ -55,3 +72,219 @@ class MassReconciledAdvancedRefDeepSearch(models.TransientModel):
             omvalue = omvalue,
         return MassReconciledAdvancedRefDeepSearch.\
             _compare_matcher_values(mkey, mvalue, omvalue)
+
+    def _is_indexable_matcher(self, key):
+        # the ref is searched inside the opposite values, only the
+        # partner is compared for equality
+        return key == 'partner_id'
+
+    def _use_ref_automaton(self):
+        """ Return True when the credit refs can be searched with a
+        `RefAutomaton`, which is the case as long as the matchers and
+        their comparison are the ones of this method
+        """
+        classes = (MassReconciledAdvancedRefDeepSearch,
+                   MassReconcileAdvancedRef, MassReconcileAdvanced)
+        for name in ('_matchers', '_opposite_matchers',
+                     '_normalize_matcher_value', '_compare_opposite',
+                     '_compare_prepared', '_compare_matchers',
+                     '_compare_matcher_values', '_compare_values'):
+            base = next(cls for cls in classes if name in vars(cls))
+            method = getattr(type(self), name)
+            base_method = getattr(base, name)
+            if (getattr(method, '__func__', method) is not
+                    getattr(base_method, '__func__', base_method)):
+                return False
+        return True
+
+    def _match_refs(self, credit_lines, debit_lines):
+        """ Find the debit lines containing the ref of each credit line
+
+        The lines are grouped by partner. For each partner, an automaton
+        is built over the refs of the credit lines and the ref and name
+        of each debit line are scanned once, instead of searching every
+        credit ref in every debit line.
+
+        :param list credit_lines: list of dict of credit move lines
+        :param list debit_lines: list of dict of debit move lines
+        :return: dict {credit line id: list of positions of the matching
+                 lines in debit_lines}
+        """
+        credit_refs = {}
+        for line in credit_lines:
+            matchers = dict(self._prepare_matchers(self._matchers(line)))
+            ref = matchers['ref'][0]
+            partner_id = matchers['partner_id'][0]
+            if ref and partner_id:
+                credit_refs.setdefault(partner_id, {}).setdefault(
+                    ref, []).append(line['id'])
+        debits_by_partner = {}
+        for position, matchers in enumerate(
+                self._prepare_opposite_matchers(debit_lines)):
+            matchers = dict(matchers)
+            partner_id = matchers['partner_id'][0]
+            if partner_id in credit_refs:
+                values = [value for value in matchers['ref'] if value]
+                if values:
+                    debits_by_partner.setdefault(partner_id, []).append(
+                        (position, values))
+        matches = {}
+        for partner_id, debits in debits_by_partner.items():
+            refs = credit_refs[partner_id]
+            automaton = RefAutomaton(refs)
+            for position, values in debits:
+                found = set()
+                for value in values:
+                    found |= automaton.search(value)
+                for ref in found:
+                    for credit_id in refs[ref]:
+                        matches.setdefault(credit_id, []).append(position)
+        return matches
+
+    @api.multi
+    def _rec_auto_lines_advanced(self, credit_lines, debit_lines):
+        """ Search the opposite lines of all the credit lines at once with
+        `_match_refs`, the credit lines are loaded in memory
+        """
+        if (self.env.context.get('mass_reconcile_ref_matches') is not None
+                or not self._use_ref_automaton()):
+            return super()._rec_auto_lines_advanced(credit_lines,
+                                                    debit_lines)
+        stats = self._get_stats()
+        with stats.timer('matching_time'):
+            credit_lines = list(credit_lines)
+            debit_lines = list(debit_lines)
+            matches = self._match_refs(credit_lines, debit_lines)
+        return super(
+            MassReconciledAdvancedRefDeepSearch,
+            self.with_context(mass_reconcile_ref_matches=matches)
+        )._rec_auto_lines_advanced(credit_lines, debit_lines)
+
+    def _search_opposites(self, move_line, opposite_move_lines, index=None,
+                          opposite_matchers=None):
+        matches = self.env.context.get('mass_reconcile_ref_matches')
+        if matches is None:
+            return super()._search_opposites(
+                move_line, opposite_move_lines, index=index,
+                opposite_matchers=opposite_matchers
+            )
+        positions = matches.get(move_line['id'], ())
+        self._get_stats().comparisons += len(positions)
+        return [opposite_move_lines[position] for position in positions]
+
+
+class MassReconciledAdvancedRefDeepSearchTrgm(models.TransientModel):
+    """ Deep search of the refs in the database
+
+    The pairs of credit and debit lines whose ref or name contains the
+    ref of the credit line are searched by PostgreSQL, using the trigram
+    indexes created on the unreconciled lines. Only the lines of these
+    pairs are loaded, and the pairs are checked with `_compare_values`.
+    """
+
+    _name = 'mass.reconcile.advanced.ref.deep.search.trgm'
+    _inherit = 'mass.reconcile.advanced.ref.deep.search'
+
+    def _trgm_available(self):
+        self.env.cr.execute(
+            "SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'"
+        )
+        return bool(self.env.cr.fetchone())
+
+    @staticmethod
+    def _like_pattern(expression):
+        """ SQL expression of a LIKE pattern searching the normalized
+        value of ``expression`` anywhere in a string
+        """
+        return ("('%%' || replace(replace(replace("
+                "lower(btrim({0}, {1})), "
+                "'\\', '\\\\'), '%%', '\\%%'), '_', '\\_') || '%%')"
+                .format(expression, _STRIP_CHARS))
+
+    def _candidate_pairs_query(self):
+        """ Query returning the ids of the credit lines and the debit lines
+        of the same partner containing their ref in their ref or name
+        """
+        where, params = self._where_query()
+        where2, params2 = self._get_filter()
+        pattern = self._like_pattern('account_move_line.ref')
+        query = ' '.join((
+            "SELECT account_move_line.id, opposite.id",
+            self._from_query(),
+            "JOIN account_move_line opposite "
+            "ON opposite.account_id = account_move_line.account_id "
+            "AND opposite.partner_id = account_move_line.partner_id "
+            "AND NOT opposite.reconciled AND opposite.debit > 0 "
+            "AND (lower(opposite.ref) LIKE {0} "
+            "     OR lower(opposite.name) LIKE {0})".format(pattern),
+            where,
+            "AND account_move_line.credit > 0 "
+            "AND account_move_line.partner_id IS NOT NULL "
+            "AND btrim(account_move_line.ref, %s) <> ''" % _STRIP_CHARS,
+            where2,
+        ))
+        params = params + params2
+        if self.resume_from_id:
+            query += " AND account_move_line.id >= %s"
+            params.append(self.resume_from_id)
+        if where2:
+            # the filter applies on the debit lines as well
+            query += (" AND opposite.id IN (SELECT account_move_line.id "
+                      "FROM account_move_line "
+                      "WHERE account_move_line.account_id = %s "
+                      "AND NOT account_move_line.reconciled " +
+                      where2 + ")")
+            params += [self.account_id.id] + params2
+        return query + " ORDER BY account_move_line.id, opposite.id", params
+
+    def _query_lines_by_ids(self, line_ids):
+        if not line_ids:
+            return []
+        query = ' '.join((
+            self._select_query(),
+            self._from_query(),
+            "WHERE account_move_line.id IN %s",
+            "ORDER BY account_move_line.id"))
+        return list(self._fetch_lines(query, [tuple(line_ids)]))
+
+    def _action_rec(self):
+        if not self._trgm_available():
+            _logger.warning("The pg_trgm extension is not installed, "
+                            "the refs are searched in memory")
+            return super()._action_rec()
+        stats = self._get_stats()
+        query, params = self._candidate_pairs_query()
+        with stats.timer('query_time'):
+            self.env.cr.execute(query, params)
+            pairs = self.env.cr.fetchall()
+        credit_lines = self._query_lines_by_ids(
+            set(credit_id for credit_id, dummy in pairs)
+        )
+        debit_lines = self._query_lines_by_ids(
+            set(debit_id for dummy, debit_id in pairs)
+        )
+        # the candidates found by the database are checked with the
+        # comparison of the method
+        with stats.timer('matching_time'):
+            credits = dict((line['id'], line) for line in credit_lines)
+            debit_positions = dict(
+                (line['id'], position)
+                for position, line in enumerate(debit_lines)
+            )
+            debit_matchers = self._prepare_opposite_matchers(debit_lines)
+            matches = {}
+            matchers = {}
+            for credit_id, debit_id in pairs:
+                position = debit_positions.get(debit_id)
+                if credit_id not in credits or position is None:
+                    continue
+                if credit_id not in matchers:
+                    matchers[credit_id] = self._prepare_matchers(
+                        self._matchers(credits[credit_id])
+                    )
+                if self._compare_prepared(matchers[credit_id],
+                                          debit_matchers[position]):
+                    matches.setdefault(credit_id, []).append(position)
+        return self.with_context(
+            mass_reconcile_ref_matches=matches
+        )._rec_auto_lines_advanced(credit_lines, debit_lines)
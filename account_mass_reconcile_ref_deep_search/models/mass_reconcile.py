@@ -12,5 +12,7 @@ class AccountMassReconcileMethod(models.Model):
         methods += [
             ('mass.reconcile.advanced.ref.deep.search',
              'Advanced. Partner and Ref. Deep Search'),
+            ('mass.reconcile.advanced.ref.deep.search.trgm',
+             'Advanced. Partner and Ref. Deep Search in Database'),
         ]
         return methods
@@ -0,0 +1,68 @@
+# Copyright 2026 Camptocamp SA
+# License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl.html)
+from collections import deque
+
+
+class RefAutomaton(object):
+    """ Aho-Corasick automaton finding the references contained in a text
+
+    The automaton is built once over a set of references, then every
+    text is scanned once, whatever the number of references.
+
+    :param references: iterable of non-empty strings
+    """
+
+    def __init__(self, references):
+        # transitions, failure link and references ending at each state,
+        # the state 0 is the root
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        for reference in set(references):
+            self._add(reference)
+        self._link()
+
+    def _add(self, reference):
+        state = 0
+        for char in reference:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] = (reference,)
+
+    def _link(self):
+        """ Compute the failure links breadth first, the references of
+        the state of a failure link are added to the references of the
+        state as they end at the same position
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                target = goto[fallback].get(char, 0)
+                fail[next_state] = target
+                if output[target]:
+                    output[next_state] = output[next_state] + output[target]
+
+    def search(self, text):
+        """ Return the set of the references contained in ``text`` """
+        goto, fail, output = self._goto, self._fail, self._output
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
@@ -1,5 +1,7 @@
 # Copyright 2019 Camptocamp SA
 # License AGPL-3.0 or later (http://www.gnu.org/licenses/agpl).
+from unittest import mock
+
 from odoo.tests import SavepointCase
 
 
@@ -37,8 +39,7 @@ class TestAccountReconcileRefDeepSearch(SavepointCase):
         })
         cls.cust_invoice.action_invoice_open()
 
-    def test_account_reconcile_ref_deep_search(self):
-        self.assertEqual(self.cust_invoice.state, 'open')
+    def _post_payment(self):
         bank_journal = self.env['account.journal'].search([
             ('type', '=', 'bank')], limit=1)
 
@@ -56,12 +57,14 @@ class TestAccountReconcileRefDeepSearch(SavepointCase):
         self.assertEqual(payment.state, 'draft')
         payment.post()
         self.assertEqual(payment.state, 'posted')
+        return payment
 
+    def _run_method(self, method):
         reconcile = self.env['account.mass.reconcile'].create({
             'name': 'Test reconcile ref deep search',
             'account': self.account_receivable.id,
             'reconcile_method': [(0, 0, {
-                'name': 'mass.reconcile.advanced.ref.deep.search',
+                'name': method,
                 'date_base_on': 'newest',
             })]
         })
@@ -69,3 +72,81 @@ class TestAccountReconcileRefDeepSearch(SavepointCase):
         reconcile.run_reconcile()
         self.assertEqual(self.cust_invoice.state, 'paid')
         self.assertEqual(reconcile.unreconciled_count, count - 2)
+
+    def test_account_reconcile_ref_deep_search(self):
+        self.assertEqual(self.cust_invoice.state, 'open')
+        self._post_payment()
+        self._run_method('mass.reconcile.advanced.ref.deep.search')
+
+    def _run_trgm_method(self, trgm_available):
+        self.assertEqual(self.cust_invoice.state, 'open')
+        self._post_payment()
+        model = type(
+            self.env['mass.reconcile.advanced.ref.deep.search.trgm'])
+        with mock.patch.object(
+                model, '_trgm_available', return_value=trgm_available), \
+                mock.patch.object(
+                    model, '_candidate_pairs_query', autospec=True,
+                    side_effect=model._candidate_pairs_query) as query:
+            self._run_method('mass.reconcile.advanced.ref.deep.search.trgm')
+        return query.called
+
+    def test_account_reconcile_ref_deep_search_trgm(self):
+        # the candidate pairs are searched by the database
+        self.assertTrue(self._run_trgm_method(True))
+
+    def test_account_reconcile_ref_deep_search_trgm_fallback(self):
+        # without pg_trgm, the method falls back to the search in memory
+        self.assertFalse(self._run_trgm_method(False))
+
+    def test_candidate_pairs_query(self):
+        # the query does not depend on pg_trgm, its indexes only make it
+        # faster
+        payment = self._post_payment()
+        credit_line = payment.move_line_ids.filtered(
+            lambda l: l.account_id == self.account_receivable)
+        debit_line = self.cust_invoice.move_id.line_ids.filtered(
+            lambda l: l.account_id == self.account_receivable)
+        # the ref is trimmed as by str.strip(), not only of its spaces
+        self.env.cr.execute(
+            "UPDATE account_move_line SET ref = %s WHERE id = %s",
+            ('\t TEST_deep_search\n', credit_line.id)
+        )
+        credit_line.invalidate_cache(['ref'])
+        rec = self.env['mass.reconcile.advanced.ref.deep.search.trgm'].create({
+            'account_id': self.account_receivable.id,
+        })
+        query, params = rec._candidate_pairs_query()
+        self.env.cr.execute(query, params)
+        pairs = self.env.cr.fetchall()
+        self.assertIn((credit_line.id, debit_line.id), pairs)
+        self.assertNotIn(debit_line.id,
+                         [credit_id for credit_id, dummy in pairs])
+
+    def test_match_refs(self):
+        rec = self.env['mass.reconcile.advanced.ref.deep.search'].create({
+            'account_id': self.account_receivable.id,
+        })
+        self.assertTrue(rec._use_ref_automaton())
+        credit_lines = [
+            {'id': 1, 'partner_id': 1, 'ref': 'INV/001', 'name': '/'},
+            {'id': 2, 'partner_id': 1, 'ref': ' inv/002 ', 'name': '/'},
+            {'id': 3, 'partner_id': 2, 'ref': 'INV/001', 'name': '/'},
+            {'id': 4, 'partner_id': 1, 'ref': 'INV/00', 'name': '/'},
+        ]
+        debit_lines = [
+            {'id': 10, 'partner_id': 1, 'ref': 'INV/001', 'name': '/'},
+            {'id': 11, 'partner_id': 1, 'ref': False,
+             'name': 'Payment of INV/002 and INV/001'},
+            {'id': 12, 'partner_id': 2, 'ref': 'INV/003', 'name': '/'},
+            {'id': 13, 'partner_id': False, 'ref': 'INV/001', 'name': '/'},
+        ]
+        matches = rec._match_refs(credit_lines, debit_lines)
+        self.assertEqual({1: [0, 1], 2: [1], 4: [0, 1]}, matches)
+        # same result as the comparison of every pair of lines
+        for credit_line in credit_lines:
+            self.assertEqual(
+                rec._search_opposites(credit_line, debit_lines),
+                [debit_lines[position]
+                 for position in matches.get(credit_line['id'], [])]
+            )